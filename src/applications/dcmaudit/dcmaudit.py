@@ -534,10 +534,10 @@ class App:
         """
         frame, overlay = self.dcm.get_current_frame_overlay()
         filename = self.dcm.get_filename()
+        # Add to database
+        db = DicomRectDB()
+        db.add_rects(filename, self.possible_rects)
         for dicomrect in self.possible_rects:
-            # Add to database
-            db = DicomRectDB()
-            db.add_rect(filename, dicomrect)
             # Redact on image
             # (this test will always be true because only visible rects are in the list)
             if (dicomrect.F() == frame and dicomrect.O() == overlay):
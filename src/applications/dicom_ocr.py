@@ -4,11 +4,14 @@
 # e.g. PYTHONPATH=../library/ ./dicom_ocr.py --rects --csv /dev/tty --use-ultrasound-regions ~/data/gdcm/gdcmData/gdcm-US-ALOKA-16.dcm
 
 import argparse
+import collections
 import csv
 import logging
+import multiprocessing
 import os
 import sys
-import pydicom
+import threading
+import time
 import numpy as np
 from DicomPixelAnon.ocrengine import OCR
 from DicomPixelAnon.ocrenum import OCREnum
@@ -16,6 +19,7 @@ from DicomPixelAnon.nerengine import NER
 from DicomPixelAnon.nerenum import NEREnum
 from DicomPixelAnon.dicomimage import DicomImage
 from DicomPixelAnon.dicomrectdb import DicomRectDB
+from DicomPixelAnon.pipeline import Pipeline, Stage
 from DicomPixelAnon.rect import DicomRectText
 from DicomPixelAnon.rect import filter_DicomRectText_list_by_fontsize
 from DicomPixelAnon.torchdicom import ScannedFormDetector
@@ -41,6 +45,47 @@ def find_file(filename : str) -> str:
 
 
 # ---------------------------------------------------------------------
+def create_engines(ocr : str = 'easyocr', pii : str = None, pii_cache : str = None):
+    """ Return (ocr_engine, nlp_engine) given the names of the OCR engine
+    and NER engine (with ,model if needed), and optionally the SQLite file
+    used to cache NER results. nlp_engine is None if pii is None or the
+    engine is not installed.
+    """
+    return OCR(ocr), create_ner(pii, pii_cache)
+
+
+def create_ner(pii : str = None, pii_cache : str = None):
+    """ Return the nlp_engine part of create_engines().
+    """
+    nlp_engine = None
+    if pii:
+        if pii_cache:
+            NER.set_memo(filename = pii_cache)
+        pii_params = pii.split(',')
+        nlp_engine = NER(pii_params[0], model = pii_params[1] if len(pii_params)>1 else None)
+        if not nlp_engine.isValid():
+            logger.warning('Cannot run NLP on the OCR output because %s is not installed' % pii_params[0])
+            nlp_engine = None
+    return nlp_engine
+
+
+# ---------------------------------------------------------------------
+def pii_from_entities(nlp_engine : NER, entities) -> int:
+    """ Return 0 or 1 given the list of entities returned by NER
+    for some text, see check_for_pii().
+    """
+    is_sensitive = -1
+    for ent in entities:
+        if ent['label'] in ['PER', 'ORG', 'LOC']:
+            is_sensitive = 1
+        elif nlp_engine.engine_enum() == NEREnum.allowlist:
+            is_sensitive = 1
+    # If no PII found then mark as checked
+    if is_sensitive == -1:
+        is_sensitive = 0
+    return is_sensitive
+
+
 def check_for_pii(nlp_engine : NER, text) -> int:
     """ Use NER (e.g. SpaCy) to check for PII in some text,
     or use a allowlist to check if text is safe.
@@ -53,18 +98,25 @@ def check_for_pii(nlp_engine : NER, text) -> int:
     """
     is_sensitive = -1
     if nlp_engine and len(text):
-        entities = nlp_engine.detect(text)
-        for ent in entities:
-            if ent['label'] in ['PER', 'ORG', 'LOC']:
-                is_sensitive = 1
-            elif nlp_engine.engine_enum() == NEREnum.allowlist:
-                is_sensitive = 1
-        # If no PII found then mark as checked
-        if is_sensitive == -1:
-            is_sensitive = 0
+        is_sensitive = pii_from_entities(nlp_engine, nlp_engine.detect(text))
     return is_sensitive
 
 
+def check_rects_for_pii(nlp_engine : NER, rectlist : list):
+    """ As check_for_pii() but for every DicomRectText in the list
+    which has not yet been checked, setting its nerpii value in-place.
+    All the texts are passed to NER as a single batch which is
+    much faster than checking each one individually.
+    """
+    if not nlp_engine:
+        return
+    rects = [ rect for rect in rectlist
+        if rect.nerpii == DicomRectText.pii_not_checked and len(rect.ocrtext) ]
+    entities_list = nlp_engine.detect_batch([ rect.ocrtext for rect in rects ])
+    for rect, entities in zip(rects, entities_list):
+        rect.nerpii = pii_from_entities(nlp_engine, entities)
+
+
 # ---------------------------------------------------------------------
 
 def check_for_scanned_form(img):
@@ -99,10 +151,9 @@ def save_rects(filename, frame, overlay, meta, ocr_rectlist : list, csv_writer =
                 is_sensitive
             ])
 
-    # Output to database
+    # Output to database, in a single transaction
     if db_writer:
-        for dicomrect in ocr_rectlist:
-            db_writer.add_rect(filename, dicomrect)
+        db_writer.add_rects(filename, ocr_rectlist)
     return
 
 
@@ -114,29 +165,46 @@ def process_image(img, filename = None,
     """ OCR the image (PIL image) extracted from a DICOM
     and optionally run NLP. Store the results in CSV and/or database.
     frame, overlay are integers (-1 if NA).
-    options dict must contain:
-      ocr_engine must be an instance of OCR().
+    options dict is as for ocr_image() and must also contain:
       nlp_engine must be an instance of NER() or None.
       csv_writer must be an instance of csv.writer() or None.
       db_writer must be an instance of DicomRectDB() or None.
+    meta dict must contain keys taken from DICOM tag values:
+      ImageType
+      ManufacturerModelName
+      BurnedInAnnotation
+    """
+    ocr_rectlist = ocr_image(img, filename = filename,
+        frame = frame, overlay = overlay, options = options)
+    check_rects_for_pii(options.get('nlp_engine', None), ocr_rectlist)
+    save_rects(filename, frame, overlay, meta, ocr_rectlist,
+        csv_writer = options.get('csv_writer', None),
+        db_writer = options.get('db_writer', None))
+    return
+
+
+def ocr_image(img, filename = None,
+        frame = -1, overlay = -1,
+        options : dict = None):
+    """ OCR the image (PIL image) extracted from a DICOM and return
+    a list of DicomRectText. NLP is not run, but the rectangles are
+    marked with the NER engine so check_rects_for_pii() can be used.
+    frame, overlay are integers (-1 if NA).
+    options dict must contain:
+      ocr_engine must be an instance of OCR().
+      nlp_engine must be an instance of NER() or None.
       us_regions=True will add rectangles from Ultrasound tags.
       except_us_regions=True will ignore text found within
       rectangles from Ultrasound tags (so there's no duplication,
       if you're redacting US regions anyway, and so you can check
       if the US regions are sufficient by looking for text outside).
       output_rects=True will output each OCR rectangle individually.
-    meta dict must contain keys taken from DICOM tag values:
-      ImageType
-      ManufacturerModelName
-      BurnedInAnnotation
     """
     ocr_engine = options.get('ocr_engine', None)
     nlp_engine = options.get('nlp_engine', None)
     output_rects = options.get('output_rects', False)
     us_regions = options.get('us_regions', False)
     except_us_regions = options.get('except_us_regions', False)
-    csv_writer = options.get('csv_writer', None)
-    db_writer = options.get('db_writer', None)
 
     # Convert from PIL Image to numpy array
     img = np.asarray(img)
@@ -159,6 +227,7 @@ def process_image(img, filename = None,
         us_rectlist = read_DicomRectText_list_from_region_tags(filename = filename)
 
     # Run OCR
+    # The PII check is done later for all rectangles together.
     logger.debug('OCR(%s,%s) %s (%d,%d)' % (ocr_engine_name, nlp_engine_name, filename, frame, overlay))
     ocr_text = ''
     if output_rects:
@@ -169,20 +238,17 @@ def process_image(img, filename = None,
         for item in ocr_data:
             if item['conf'] > OCR.confidence_threshold:
                 ocr_text += item['text'] + ' '
-                is_sensitive = check_for_pii(nlp_engine, item['text'])
                 ocr_rectlist.append( DicomRectText(arect = item['rect'],
                     frame=frame, overlay=overlay,
                     ocrengine=ocr_engine_enum, ocrtext=item['text'],
-                    nerengine=nlp_engine_enum, nerpii=is_sensitive) )
+                    nerengine=nlp_engine_enum, nerpii=DicomRectText.pii_not_checked) )
         # Now append the whole string with a null rectangle
-        is_sensitive = check_for_pii(nlp_engine, ocr_text)
         ocr_rectlist.append( DicomRectText(ocrengine=ocr_engine_enum, ocrtext=ocr_text,
-            nerengine=nlp_engine_enum, nerpii=is_sensitive) )
+            nerengine=nlp_engine_enum, nerpii=DicomRectText.pii_not_checked) )
     else:
         ocr_text = ocr_engine.image_to_text(img)
-        is_sensitive = check_for_pii(nlp_engine, ocr_text)
         ocr_rectlist.append( DicomRectText(ocrengine=ocr_engine_enum, ocrtext=ocr_text,
-            nerengine=nlp_engine_enum, nerpii=is_sensitive) )
+            nerengine=nlp_engine_enum, nerpii=DicomRectText.pii_not_checked) )
 
     # Filter out huge rectangles
     ocr_rectlist = filter_DicomRectText_list_by_fontsize(ocr_rectlist)
@@ -193,10 +259,7 @@ def process_image(img, filename = None,
             return any([r.contains_rect(rect) for r in rectlist])
         ocr_rectlist = [ rect for rect in ocr_rectlist if not rect_within_rectlist(rect, us_rectlist) ]
 
-    save_rects(filename, frame, overlay, meta, ocr_rectlist,
-        csv_writer = csv_writer, db_writer = db_writer)
-
-    return
+    return ocr_rectlist
 
 
 # ---------------------------------------------------------------------
@@ -205,30 +268,56 @@ def process_image(img, filename = None,
 def process_dicom(filename, options : dict):
     """ Examine every frame in the DICOM file and run OCR.
     Add rectangles to database or CSV.
+    options are as for ocr_dicom() and save_dicom().
+    """
+    result = ocr_dicom(filename, options)
+    if result:
+        save_dicom(filename, *result, options = options)
+    return
+
+
+def ocr_dicom(filename, options : dict):
+    """ Examine every frame in the DICOM file, run OCR and check the
+    text for PII, without saving anything. Returns (meta, frame_rectlists)
+    where frame_rectlists is a list of (frame, overlay, rectlist),
+    or None if the file cannot be read.
     options should contain:
     ocr_engine: OCR = None, nlp_engine: NER = None,
-    csv_writer = None, db_writer: DicomRectDB = None, options : dict):
     output_rects = False, redact_forms = False, ignore_overlays = False,
     us_regions = False, except_us_regions = False
     """
+    decoded = decode_dicom(filename, options)
+    if not decoded:
+        return None
+    meta, images = decoded
+    frame_rectlists = ocr_frames(filename, meta, images, options)
+    # Check for PII in all the frames at once
+    check_rects_for_pii(options.get('nlp_engine', None),
+        [ rect for _, _, rectlist in frame_rectlists for rect in rectlist ])
+    return meta, frame_rectlists
+
+
+def decode_dicom(filename, options : dict):
+    """ Read the DICOM file and return (meta, images) where images is an
+    iterator of (frame, overlay, PIL image) for every frame and overlay
+    frame (except overlays if ignore_overlays is in options), which
+    decodes each frame as it is needed, or None if the file cannot be read.
+    """
 
-    # Attempt to read and parse as DICOM
+    # Attempt to read and parse as DICOM, this decodes the pixel data
+    # so use its dataset rather than reading and decoding it again
     try:
-        ds = pydicom.dcmread(filename)
         dicomimg = DicomImage(filename)
+        ds = dicomimg.get_dataset()
     except Exception as e:
         logger.error('ERROR reading DICOM file %s (%s)' % (filename, e))
-        return
+        return None
 
     # Check that it's an image file
     if not 'PixelData' in ds:
         logger.warning('No pixel data in %s' % filename)
-        return
-    try:
-        pixel_data = ds.pixel_array
-    except Exception as e:
-        logger.error('ERROR decoding pixel data from DICOM file %s (%s)' % (filename, e))
-        return
+        return None
+    pixel_data = dicomimg.pixel_data
 
     # Check for multiple frames
     num_frames = ds['NumberOfFrames'].value if 'NumberOfFrames' in ds else 1
@@ -242,16 +331,35 @@ def process_dicom(filename, options : dict):
     # Get some tag values massaged to return proper values
     meta = dicomimg.get_selected_metadata()
 
-    # Save all the frames
-    for idx in range(dicomimg.get_total_frames()):
-        logger.info(" extracting frame %d from %s" % (idx, filename))
-        try:
-            img = dicomimg.next_image()
-        except Exception as e:
-            logger.error('Cannot extract frame %d from %s (%s)' % (idx, filename, e))
-            continue
-        frame, overlay = dicomimg.get_current_frame_overlay()
-        if idx == 0 and options.get('redact_forms', None):
+    def images():
+        for idx in range(dicomimg.get_total_frames()):
+            logger.info(" extracting frame %d from %s" % (idx, filename))
+            try:
+                img = dicomimg.next_image()
+            except Exception as e:
+                logger.error('Cannot extract frame %d from %s (%s)' % (idx, filename, e))
+                continue
+            frame, overlay = dicomimg.get_current_frame_overlay()
+            if options['ignore_overlays'] and overlay != -1:
+                continue
+            if not img:
+                logger.error('Cannot extract frame %d overlay %d from %s' % (frame, overlay, filename))
+                continue
+            yield frame, overlay, img
+    return meta, images()
+
+
+def ocr_frames(filename, meta, images, options : dict):
+    """ OCR the (frame, overlay, image) from decode_dicom() and return
+    a list of (frame, overlay, rectlist). If the first frame is a scanned
+    form (and redact_forms is in options) then the list has only a
+    rectangle covering that frame.
+    """
+    # OCR all the frames, keeping the rectangles from each frame
+    # so that NER can be run on all the text in the file at once.
+    frame_rectlists = []   # list of (frame, overlay, rectlist)
+    for frame, overlay, img in images:
+        if (frame, overlay) == (0, -1) and options.get('redact_forms', None):
             if check_for_scanned_form(img):
                 max_rectlist = [
                     DicomRectText(0, meta['Rows']-1, 0, meta['Columns']-1,
@@ -259,14 +367,23 @@ def process_dicom(filename, options : dict):
                     ocrengine=OCREnum.ScannedForm, ocrtext='SCANNED_FORM',
                     nerengine=NEREnum.scannedform, nerpii=True)
                 ]
-                save_rects(filename, frame, overlay, meta, max_rectlist, options['csv_writer'], options['db_writer'])
-                break # no need for other frames
-        if options['ignore_overlays'] and overlay != -1:
-            continue
-        if not img:
-            logger.error('Cannot extract frame %d overlay %d from %s' % (frame, overlay, filename))
-            continue
-        process_image(img, filename=filename, frame=frame, overlay=overlay, options = options, meta = meta)
+                return [ (frame, overlay, max_rectlist) ]
+        frame_rectlists.append( (frame, overlay,
+            ocr_image(img, filename=filename, frame=frame, overlay=overlay, options = options)) )
+    return frame_rectlists
+
+
+def save_dicom(filename, meta, frame_rectlists, options : dict):
+    """ Save the results of ocr_dicom() to CSV and/or database.
+    options should contain csv_writer and db_writer (each may be None).
+    """
+    for frame, overlay, rectlist in frame_rectlists:
+        save_rects(filename, frame, overlay, meta, rectlist,
+            csv_writer = options.get('csv_writer', None))
+    # All the frames go into the database in one transaction
+    if options.get('db_writer', None):
+        options['db_writer'].add_many( (filename, rect)
+            for _, _, rectlist in frame_rectlists for rect in rectlist )
     return
 
 
@@ -309,6 +426,362 @@ def file_list(args_list):
             yield file
 
 
+class WorkLeases:
+    """ The files claimed from the database work queue by this process
+    which have not been finished yet. A thread renews their leases every
+    third of DicomRectDB.lease_seconds, using its own database connection,
+    so files which wait a long time (e.g. in the queues of a pipeline) or
+    take a long time are not claimed again by another worker.
+    Call close() when finished.
+    """
+    def __init__(self):
+        self._files = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target = self._renew, name = 'lease-renewal', daemon = True)
+        self._thread.start()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._files)
+
+    def add(self, filename):
+        with self._lock:
+            self._files.add(filename)
+
+    def discard(self, filename):
+        with self._lock:
+            self._files.discard(filename)
+
+    def _renew(self):
+        db = None
+        while not self._stop.wait(DicomRectDB.lease_seconds / 3):
+            with self._lock:
+                files = list(self._files)
+            if not files:
+                continue
+            try:
+                db = db or DicomRectDB()
+                for file in files:
+                    if not db.renew_work(file):
+                        logger.warning('lease of %s lost to another worker' % file)
+                        self.discard(file)
+            except Exception:
+                logger.exception('cannot renew the work queue leases')
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+
+
+def claim_files(db_writer : DicomRectDB, count = 1, leases : WorkLeases = None):
+    """ Iterator that returns filenames claimed from the database work
+    queue, count at a time, until the queue is empty. The claimed files
+    are added to leases, if given, to keep them until finish_work().
+    """
+    while True:
+        claimed = db_writer.claim_work(count)
+        if not claimed:
+            break
+        if leases is not None:
+            for file in claimed:
+                leases.add(file)
+        yield from claimed
+
+
+def finish_work(db_writer : DicomRectDB, filename, seconds = None, error = None, leases : WorkLeases = None):
+    """ Mark a claimed file as done in the database work queue, or failed
+    if there was an error, and stop renewing its lease. A warning is logged
+    if the lease had been lost, as another worker will process it again.
+    """
+    if leases is not None:
+        leases.discard(filename)
+    if error:
+        ok = db_writer.fail_work(filename, error)
+    else:
+        ok = db_writer.complete_work(filename, seconds = seconds)
+    if not ok:
+        logger.warning('lease of %s had been lost to another worker' % filename)
+    return ok
+
+
+def process_queue(db_writer : DicomRectDB, func):
+    """ Claim files from the database work queue one at a time and call
+    func(filename) on each, marking them done, or failed if func raises
+    an exception, until the queue is empty. Any number of processes,
+    on any number of nodes sharing the database, can run this at once.
+    Returns the number of files processed.
+    """
+    count = 0
+    leases = WorkLeases()
+    try:
+        for file in claim_files(db_writer, leases = leases):
+            start = time.perf_counter()
+            try:
+                func(file)
+            except Exception as e:
+                logger.exception('failed to process %s' % file)
+                finish_work(db_writer, file, error = repr(e), leases = leases)
+                continue
+            finish_work(db_writer, file, seconds = time.perf_counter() - start, leases = leases)
+            count += 1
+    finally:
+        leases.close()
+    logger.info('work queue empty after %d files, status %s' % (count, db_writer.work_status()))
+    return count
+
+
+# ---------------------------------------------------------------------
+# Run ocr_dicom in a pool of worker processes.
+# Each worker creates its own OCR and NER engines once, in
+# init_worker, and returns its results to the parent which is
+# the only process writing to the CSV file and the database.
+
+_worker_options = None
+
+def init_worker(engine_args : dict, options : dict, processes : int):
+    """ Initialise a worker process: take a share of the GPU memory
+    and CPU threads, and create the engines given create_engines() args.
+    """
+    global _worker_options
+    DicomPixelAnon.torchmem.share_between(processes)
+    ocr_engine, nlp_engine = create_engines(**engine_args)
+    _worker_options = dict(options, ocr_engine = ocr_engine, nlp_engine = nlp_engine,
+        csv_writer = None, db_writer = None)
+
+
+def ocr_dicom_worker(filename):
+    """ Run ocr_dicom in a worker process, returns (result, seconds, error)
+    where error is None or the exception message.
+    """
+    start = time.perf_counter()
+    try:
+        result, error = ocr_dicom(filename, _worker_options), None
+    except Exception as e:
+        logger.exception('failed to process %s' % filename)
+        result, error = None, repr(e)
+    return result, time.perf_counter() - start, error
+
+
+def ocr_dicom_parallel(filenames, jobs : int, engine_args : dict, options : dict):
+    """ Run ocr_dicom() on each of the filenames using jobs worker
+    processes and yield (filename, result, seconds, error) in the same
+    order as the filenames, so the caller can save them. At most
+    2*jobs files are in progress, so filenames is read lazily and
+    the results waiting to be saved are bounded. engine_args are
+    passed to create_engines(), options to ocr_dicom() (without the
+    engines and writers, which cannot be shared between processes).
+    The workers are spawned, not forked, so that each can initialise
+    CUDA and its own database-free state.
+    """
+    options = { key: val for key, val in options.items()
+        if key not in ['ocr_engine', 'nlp_engine', 'csv_writer', 'db_writer'] }
+    ctx = multiprocessing.get_context('spawn')
+    with ctx.Pool(jobs, initializer = init_worker, initargs = (engine_args, options, jobs)) as pool:
+        pending = collections.deque()
+        for filename in filenames:
+            pending.append( (filename, pool.apply_async(ocr_dicom_worker, (filename,))) )
+            if len(pending) >= 2 * jobs:
+                filename, async_result = pending.popleft()
+                yield (filename, *async_result.get())
+        while pending:
+            filename, async_result = pending.popleft()
+            yield (filename, *async_result.get())
+
+
+# ---------------------------------------------------------------------
+# Run the files through a pipeline of stages, each with its own threads,
+# so that reading and decoding the next files overlaps with the OCR:
+#   decode (I/O bound, several threads) -> OCR (one engine per thread)
+#   -> NER (one thread, a batch of files at once)
+#   -> persist (one thread, writes a batch of files in one transaction)
+# Each file is a dict passed from stage to stage. An error in one
+# stage is recorded in the dict and the later stages pass it along.
+# The decode stage reads and decompresses the pixel data, and the OCR
+# stage makes the image of each frame as it needs it. The queue into
+# the OCR stage only holds one file per OCR thread, so at most
+# decode_threads + 2 * ocr_threads decoded files are in memory.
+
+def ocr_dicom_pipeline(filenames, engine_args : dict, options : dict,
+        decode_threads = 2, ocr_threads = 1, batch = 16,
+        db_factory = None, queue = False, leases = None, report_interval = None):
+    """ Run ocr_dicom() and save_dicom() on each of the filenames in a
+    Pipeline, and return the Pipeline so its stats() can be examined.
+    engine_args are passed to create_engines(), each OCR thread gets its
+    own OCR engine and the NER thread its own NER engine. options are as
+    for ocr_dicom() and save_dicom() except that the database is opened
+    in the persist thread by calling db_factory() (e.g. DicomRectDB)
+    because a connection cannot be shared between threads.
+    If queue is True the files are marked done (or failed) in the
+    database work queue when they have been saved, see finish_work()
+    (leases being the WorkLeases of the claimed files). A file which
+    fails in any stage, including being saved, is marked failed.
+    The files are saved in no particular order.
+    """
+    # Every claimed file must reach persist to be marked done or failed
+    # in the work queue, so the stages record errors in the item rather
+    # than raise, and a stage which cannot start fails every item.
+    def cannot_start(stage, e):
+        logger.error('cannot start the %s stage (%s)' % (stage, e))
+        def fail(item):
+            item['error'] = item.get('error') or repr(e)
+            item['images'] = None
+            return item
+        return fail
+
+    def decode(item):
+        item['start'] = time.perf_counter()
+        try:
+            decoded = decode_dicom(item['filename'], options)
+            if decoded:
+                item['meta'], item['images'] = decoded
+        except Exception as e:
+            logger.exception('failed to decode %s' % item['filename'])
+            item['error'] = repr(e)
+        return item
+
+    def make_ocr():
+        try:
+            ocr_options = dict(options, ocr_engine = OCR(engine_args.get('ocr', 'easyocr')))
+        except Exception as e:
+            return cannot_start('ocr', e)
+        def ocr(item):
+            if item.get('images') is not None and not item.get('error'):
+                try:
+                    item['frame_rectlists'] = ocr_frames(item['filename'], item['meta'], item['images'], ocr_options)
+                except Exception as e:
+                    logger.exception('failed to OCR %s' % item['filename'])
+                    item['error'] = repr(e)
+            item['images'] = None
+            return item
+        return ocr
+
+    def batched(func):
+        # A Stage with batch 1 calls func with one item rather than a list
+        return func if batch > 1 else lambda item: func([item])[0]
+
+    def make_ner():
+        try:
+            nlp_engine = create_ner(engine_args.get('pii'), engine_args.get('pii_cache'))
+        except Exception as e:
+            fail = cannot_start('ner', e)
+            return batched(lambda items: [ fail(item) for item in items ])
+        def ner(items):
+            items_ok = [ item for item in items if item.get('frame_rectlists') and not item.get('error') ]
+            try:
+                rects = [ rect for item in items_ok
+                    for _, _, rectlist in item['frame_rectlists'] for rect in rectlist ]
+                # The OCR threads do not know which NER engine will be used
+                if nlp_engine:
+                    for rect in rects:
+                        if rect.nerpii == DicomRectText.pii_not_checked:
+                            rect.nerengine = nlp_engine.engine_enum()
+                check_rects_for_pii(nlp_engine, rects)
+            except Exception as e:
+                logger.exception('failed to check for PII')
+                for item in items_ok:
+                    item['error'] = repr(e)
+            return items
+        return batched(ner)
+
+    def make_persist():
+        try:
+            db_writer = db_factory() if db_factory else None
+        except Exception as e:
+            logger.exception('cannot start the persist stage')
+            def give_up(items):
+                # Stop renewing the leases so another worker can claim the files
+                for item in items:
+                    if leases is not None:
+                        leases.discard(item['filename'])
+                return items
+            return batched(give_up)
+        save_options = dict(options, db_writer = None)
+        def persist(items):
+            items_ok = []
+            for item in items:
+                if item.get('frame_rectlists') and not item.get('error'):
+                    try:
+                        save_dicom(item['filename'], item['meta'], item['frame_rectlists'], save_options)
+                        items_ok.append(item)
+                    except Exception as e:
+                        logger.exception('failed to save %s' % item['filename'])
+                        item['error'] = repr(e)
+            # All the files in the batch go into the database in one transaction
+            if db_writer and items_ok:
+                try:
+                    db_writer.add_many( (item['filename'], rect) for item in items_ok
+                        for _, _, rectlist in item['frame_rectlists'] for rect in rectlist )
+                except Exception as e:
+                    logger.exception('failed to save %d files in the database' % len(items_ok))
+                    for item in items_ok:
+                        item['error'] = repr(e)
+            if queue:
+                for item in items:
+                    try:
+                        finish_work(db_writer, item['filename'], seconds = time.perf_counter() - item['start'],
+                            error = item.get('error'), leases = leases)
+                    except Exception:
+                        logger.exception('cannot update the work queue for %s' % item['filename'])
+            return items
+        return batched(persist)
+
+    pipeline = Pipeline([
+        Stage('decode', decode, threads = decode_threads),
+        Stage('ocr', factory = make_ocr, threads = ocr_threads, maxsize = ocr_threads),
+        Stage('ner', factory = make_ner, batch = batch),
+        Stage('persist', factory = make_persist, batch = batch),
+        ], maxsize = max(batch, 2 * max(decode_threads, ocr_threads)))
+    pipeline.run(({ 'filename': filename } for filename in filenames), report_interval = report_interval)
+    return pipeline
+
+
+# ---------------------------------------------------------------------
+def test_pipeline_errors(tmpdir, monkeypatch):
+    """ Every claimed file is marked done or failed in the work queue,
+    whichever stage fails, including saving it.
+    """
+    dbfile = os.path.join(tmpdir, 'queue.sqlite.db')
+    class FailingDB(DicomRectDB):
+        def add_many(self, filename_rects):
+            filename_rects = list(filename_rects)
+            if any(filename == 'f4' for filename, _ in filename_rects):
+                raise RuntimeError('database error')
+            return super().add_many(filename_rects)
+    def fake_decode(filename, options):
+        if filename == 'f1':
+            raise ValueError('cannot decode')
+        return {}, iter([])
+    def fake_ocr(filename, meta, images, options):
+        return [(0, -1, [DicomRectText(1, 2, 3, 4, ocrtext = filename)])]
+    def fake_save(filename, meta, frame_rectlists, options):
+        if filename == 'f3':
+            raise OSError('disk full')
+    monkeypatch.setattr(sys.modules[__name__], 'OCR', lambda name: None)
+    monkeypatch.setattr(sys.modules[__name__], 'decode_dicom', fake_decode)
+    monkeypatch.setattr(sys.modules[__name__], 'ocr_frames', fake_ocr)
+    monkeypatch.setattr(sys.modules[__name__], 'save_dicom', fake_save)
+    db = DicomRectDB(dbfile)
+    db.queue_files(['f%d' % idx for idx in range(6)])
+    leases = WorkLeases()
+    pipeline = ocr_dicom_pipeline(claim_files(db, 2, leases = leases), {}, {},
+        batch = 1, db_factory = lambda: FailingDB(dbfile), queue = True, leases = leases)
+    leases.close()
+    status = db.work_status()
+    assert len(leases) == 0 and 'leased' not in status
+    # The failed files are queued to be tried again
+    assert (status.get('done'), status.get('queued')) == (3, 3)
+    assert db.query_rects('f0') and not db.query_rects('f4')
+    # A stage which cannot start fails every file rather than dropping it
+    monkeypatch.setattr(sys.modules[__name__], 'OCR', lambda name: 1/0)
+    leases = WorkLeases()
+    ocr_dicom_pipeline(claim_files(db, 2, leases = leases), {}, {},
+        batch = 2, db_factory = lambda: DicomRectDB(dbfile), queue = True, leases = leases)
+    leases.close()
+    status = db.work_status()
+    assert len(leases) == 0 and 'leased' not in status and status.get('done') == 3
+
+
 # ---------------------------------------------------------------------
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='DICOM image OCR and NER')
@@ -316,16 +789,24 @@ if __name__ == "__main__":
     parser.add_argument('-d', '--debug', action="store_true", help='more verbose (show DEBUG messages)')
     parser.add_argument('--ocr', action='store', help='OCR using "tesseract" or "easyocr"', default='easyocr')
     parser.add_argument('--db',  action="store", help='output to database directory (or specify "default")', default=False)
+    parser.add_argument('--db-shard', action="store", help='output to dcmaudit.SHARD.sqlite.db in the database directory, merge later with dicomrectdb_merge.py', default=None)
     parser.add_argument('--csv', action="store", help='output to CSV file', default=False)
     parser.add_argument('--csv-header', action="store_true", help='output CSV header when using --csv', default=True)
     parser.add_argument('--no-csv-header', action="store_true", help='do not output CSV header when using --csv', default=False)
     parser.add_argument('--pii', action='store', help='Check OCR output for PII using "spacy" or "flair" or "stanford" or "stanza" (add ,model if needed)', default=None)
+    parser.add_argument('--pii-cache', action='store', help='SQLite file to cache PII results, can be shared between processes', default=None)
     parser.add_argument('--use-ultrasound-regions', action='store_true', help='collect rectangles from Ultrasound region tags', default=False)
     parser.add_argument('--except-ultrasound-regions', action='store_true', help='ignore OCR inside rectangles from Ultrasound region tags', default=False)
     parser.add_argument('--rects', action="store_true", help='Output each OCR rectangle separately with coordinates', default=False)
     parser.add_argument('--forms', action="store_true", help='Detect scanned forms and redact the whole image', default=False)
     parser.add_argument('--no-overlays', action="store_true", help='Do not process any DICOM overlays', default=False)
     parser.add_argument('--review', action="store_true", help='Ignore database and perform OCR again', default=False)
+    parser.add_argument('--queue', action="store_true", help='add the files to the database work queue then process files from the queue until it is empty, run as many as you like at once', default=False)
+    parser.add_argument('--jobs', action="store", type=int, help='number of worker processes running OCR and NER (default 1, no workers)', default=1)
+    parser.add_argument('--pipeline', action="store_true", help='decode, OCR, NER and save different files at the same time in separate threads', default=False)
+    parser.add_argument('--decode-threads', action="store", type=int, help='number of threads reading DICOM files with --pipeline (default 2)', default=2)
+    parser.add_argument('--ocr-threads', action="store", type=int, help='number of threads, each with its own OCR engine, with --pipeline (default 1)', default=1)
+    parser.add_argument('--batch', action="store", type=int, help='number of files per NER batch and per database transaction with --pipeline (default 16)', default=16)
     parser.add_argument('files', nargs=argparse.REMAINDER)
     args = parser.parse_args()
 
@@ -337,20 +818,16 @@ if __name__ == "__main__":
     else:
         logging.basicConfig(level = logging.WARNING)
 
-    # Initialise the OCR functions
+    # Initialise the OCR for detecting text and the NLP for detecting PII,
+    # in this process unless they are needed in every worker process
+    engine_args = { 'ocr': args.ocr, 'pii': args.pii, 'pii_cache': args.pii_cache }
     ocr_engine = None
     nlp_engine = None
-
-    # Initialise the OCR for detecting text
-    ocr_engine = OCR(args.ocr)
-
-    # Initialise the NLP for detecting PII
-    if args.pii:
-        pii_params = args.pii.split(',')
-        nlp_engine = NER(pii_params[0], model = pii_params[1] if len(pii_params)>1 else None)
-        if not nlp_engine.isValid():
-            logger.warning('Cannot run NLP on the OCR output because %s is not installed' % pii_params[0])
-            nlp_engine = None
+    if args.pipeline and args.jobs > 1:
+        logger.error('use either --pipeline or --jobs, not both')
+        sys.exit(1)
+    if args.jobs <= 1 and not args.pipeline:
+        ocr_engine, nlp_engine = create_engines(**engine_args)
 
     # Output header for CSV format
     csv_writer = None
@@ -380,32 +857,78 @@ if __name__ == "__main__":
     if args.db:
         if args.db not in ['', None, '-', 'default']:
             DicomRectDB.set_db_path(args.db)
+            DicomRectDB.set_db_shard(args.db_shard)
             db_writer = DicomRectDB()
 
-    # Process files
-    for file in file_list(args.files):
-        # If already in database then ignore
-        if db_writer and not args.review:
-            if db_writer.query_rects(file):
+    if args.queue and not db_writer:
+        logger.error('--queue needs a --db to hold the work queue')
+        sys.exit(1)
+
+    # Files already in the database are skipped, unless reviewing
+    processed = None
+    if db_writer and not args.review:
+        processed = db_writer.processed_filenames()
+        logger.debug('%d files already in database' % len(processed))
+
+    options = {
+        'ocr_engine' : ocr_engine,
+        'nlp_engine' : nlp_engine,
+        'csv_writer' : csv_writer,
+        'db_writer' : db_writer,
+        'output_rects' : args.rects,
+        'ignore_overlays' : args.no_overlays,
+        'redact_forms' : args.forms,
+        'us_regions' : args.use_ultrasound_regions,
+        'except_us_regions' : args.except_ultrasound_regions,
+    }
+
+    def wanted_files():
+        """ The files given, ignoring those already in the database """
+        for file in file_list(args.files):
+            # If already in database then ignore
+            if processed and file in processed:
                 logger.debug("ignore (already in db) %s" % file)
                 continue
-        # Find full path if given relative to PACS_ROOT
-        file = find_file(file)
-        # Test database again with full pathname
-        if db_writer and not args.review:
-            if db_writer.query_rects(file):
+            # Find full path if given relative to PACS_ROOT
+            file = find_file(file)
+            if not file:
+                continue
+            # Test database again with full pathname
+            if processed and file in processed:
                 logger.debug("ignore (already in db) %s" % file)
                 continue
-        # Run the OCR
-        options = {
-            'ocr_engine' : ocr_engine,
-            'nlp_engine' : nlp_engine,
-            'csv_writer' : csv_writer,
-            'db_writer' : db_writer,
-            'output_rects' : args.rects,
-            'ignore_overlays' : args.no_overlays,
-            'redact_forms' : args.forms,
-            'us_regions' : args.use_ultrasound_regions,
-            'except_us_regions' : args.except_ultrasound_regions,
-        }
-        process_dicom(file, options = options)
+            if processed is not None:
+                processed.add(file)
+            yield file
+
+    # Process the files given, or queue them all (a batch per transaction)
+    # then process files from the queue, including those queued by others
+    files = wanted_files()
+    leases = None
+    if args.queue:
+        logger.info('queued %d new files' % db_writer.queue_files(files))
+        if args.pipeline or args.jobs > 1:
+            # Many files are claimed before they are processed
+            leases = WorkLeases()
+            files = claim_files(db_writer, args.batch if args.pipeline else max(1, args.jobs), leases)
+
+    if args.pipeline:
+        pipeline = ocr_dicom_pipeline(files, engine_args, options,
+            decode_threads = args.decode_threads, ocr_threads = args.ocr_threads,
+            batch = args.batch, db_factory = DicomRectDB if db_writer else None,
+            queue = args.queue, leases = leases, report_interval = 60 if args.verbose or args.debug else None)
+        print(pipeline.report(), file = sys.stderr)
+    elif args.jobs > 1:
+        # The workers run OCR and NER, this process writes the results in order
+        for file, result, seconds, error in ocr_dicom_parallel(files, args.jobs, engine_args, options):
+            if result:
+                save_dicom(file, *result, options = options)
+            if args.queue:
+                finish_work(db_writer, file, seconds = seconds, error = error, leases = leases)
+    elif args.queue:
+        process_queue(db_writer, lambda file: process_dicom(file, options = options))
+    else:
+        for file in files:
+            process_dicom(file, options = options)
+    if leases is not None:
+        leases.close()
@@ -45,13 +45,16 @@ def main():
     parser.add_argument('-d', '--debug', action="store_true", help='more verbose (show DEBUG messages)')
     parser.add_argument('--ocr', action='store', help='OCR using "tesseract" or "easyocr"', default='easyocr')
     parser.add_argument('--db',  action="store", help='output to database directory (or specify "default")', default=False)
+    parser.add_argument('--db-shard', action="store", help='output to dcmaudit.SHARD.sqlite.db in the database directory, merge later with dicomrectdb_merge.py', default=None)
     parser.add_argument('--pii', action='store', help='Check OCR output for PII using "spacy" or "flair" or "stanford" or "stanza" (add ,model if needed)', default=None)
+    parser.add_argument('--pii-cache', action='store', help='SQLite file to cache PII results, can be shared between processes', default=None)
     parser.add_argument('--use-ultrasound-regions', action='store_true', help='collect rectangles from Ultrasound region tags', default=False)
     parser.add_argument('--except-ultrasound-regions', action='store_true', help='ignore OCR inside rectangles from Ultrasound region tags', default=False)
     parser.add_argument('--rects', action="store_true", help='Output each OCR rectangle separately with coordinates', default=False)
     parser.add_argument('--forms', action="store_true", help='Detect scanned forms and redact the whole image', default=False)
     parser.add_argument('--no-overlays', action="store_true", help='Do not process any DICOM overlays', default=False)
     parser.add_argument('--review', action="store_true", help='Ignore database and perform OCR again', default=False)
+    parser.add_argument('--queue', action="store_true", help='add the files to the database work queue then OCR and redact files from the queue until it is empty, run as many as you like at once (each with its own --write-csv)', default=False)
     parser.add_argument('--deid', action="store_true", help='Use deid-recipe rules to redact', default=False)
     parser.add_argument('--deid-rules', action="store", help='Path to file or directory containing deid recipe files (deid.dicom.*)', default=None)
     parser.add_argument('-o', '--output', dest='output', action="store", help='Output DICOM dir or filename (created automatically if not specified)', default=[])
@@ -83,6 +86,8 @@ def main():
 
     # Initialise the NLP for detecting PII
     if args.pii:
+        if args.pii_cache:
+            NER.set_memo(filename = args.pii_cache)
         pii_params = args.pii.split(',')
         nlp_engine = NER(pii_params[0], model = pii_params[1] if len(pii_params)>1 else None)
         if not nlp_engine.isValid():
@@ -94,36 +99,30 @@ def main():
     if args.db:
         if args.db not in ['', None, '-', 'default']:
             DicomRectDB.set_db_path(args.db)
+            DicomRectDB.set_db_shard(args.db_shard)
             db_writer = DicomRectDB()
 
-    # Detect text in DICOM files
-    for file in dicom_ocr.file_list(args.files):
-        # If already in database then ignore
-        if db_writer and not args.review:
-            if db_writer.query_rects(file):
-                logger.debug("ignore (already in db) %s" % file)
-                continue
-        # Find full path if given relative to PACS_ROOT
-        file = dicom_ocr.find_file(file)
-        # Test database again with full pathname
-        if db_writer and not args.review:
-            if db_writer.query_rects(file):
-                logger.debug("ignore (already in db) %s" % file)
-                continue
-        # Run the OCR
-        options = {
-            'ocr_engine' : ocr_engine,
-            'nlp_engine' : nlp_engine,
-            'csv_writer' : None,
-            'db_writer' : db_writer,
-            'output_rects' : args.rects,
-            'ignore_overlays' : args.no_overlays,
-            'redact_forms' : args.forms,
-            'us_regions' : args.use_ultrasound_regions,
-            'except_us_regions' : args.except_ultrasound_regions,
-        }
-        logger.debug('OCR %s' % file)
-        dicom_ocr.process_dicom(file, options = options)
+    if args.queue and not db_writer:
+        logger.error('--queue needs a --db to hold the work queue')
+        return
+
+    # Files already in the database are skipped, unless reviewing
+    processed = None
+    if db_writer and not args.review:
+        processed = db_writer.processed_filenames()
+        logger.debug('%d files already in database' % len(processed))
+
+    options = {
+        'ocr_engine' : ocr_engine,
+        'nlp_engine' : nlp_engine,
+        'csv_writer' : None,
+        'db_writer' : db_writer,
+        'output_rects' : args.rects,
+        'ignore_overlays' : args.no_overlays,
+        'redact_forms' : args.forms,
+        'us_regions' : args.use_ultrasound_regions,
+        'except_us_regions' : args.except_ultrasound_regions,
+    }
 
     # Open CSV file for rectangles
     if args.csvout:
@@ -132,9 +131,8 @@ def main():
         csvw = csv.DictWriter(csvfd, fieldnames=fieldnames, lineterminator='\n', quoting=csv.QUOTE_MINIMAL)
         csvw.writeheader()
 
-
-    # Redact DICOM files
-    for infilename in dicom_ocr.file_list(args.files):
+    # Redact one DICOM file
+    def redact(infilename):
         logger.debug('REDACT %s' % infilename)
         rect_list = db_writer.query_rects(infilename,
             ignore_allowlisted = True, ignore_summaries = True)
@@ -180,6 +178,44 @@ def main():
                         'frame': rect.F(),
                         'overlay': rect.O()})
 
+    # Detect text in DICOM files, unless they are queued below
+    for file in ([] if args.queue else dicom_ocr.file_list(args.files)):
+        # If already in database then ignore
+        if processed and file in processed:
+            logger.debug("ignore (already in db) %s" % file)
+            continue
+        # Find full path if given relative to PACS_ROOT
+        file = dicom_ocr.find_file(file)
+        if not file:
+            continue
+        # Test database again with full pathname
+        if processed and file in processed:
+            logger.debug("ignore (already in db) %s" % file)
+            continue
+        if processed is not None:
+            processed.add(file)
+        # Run the OCR
+        logger.debug('OCR %s' % file)
+        dicom_ocr.process_dicom(file, options = options)
+
+    # With a work queue each file is detected then redacted before the next
+    if args.queue:
+        # All files are queued because they all need redacting,
+        # a batch per transaction as the list is read
+        found = (dicom_ocr.find_file(file) for file in dicom_ocr.file_list(args.files))
+        logger.info('queued %d new files' % db_writer.queue_files(file for file in found if file))
+        def ocr_and_redact(file):
+            if args.review or not db_writer.exists(file):
+                logger.debug('OCR %s' % file)
+                dicom_ocr.process_dicom(file, options = options)
+            redact(file)
+        dicom_ocr.process_queue(db_writer, ocr_and_redact)
+        return
+
+    # Redact DICOM files
+    for infilename in dicom_ocr.file_list(args.files):
+        redact(infilename)
+
 
 
 
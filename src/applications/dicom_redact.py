@@ -26,6 +26,7 @@ try:
 except:
     from pydicom.pixel_data_handlers.numpy_handler import pack_bits
 from DicomPixelAnon.rect import DicomRect, DicomRectText
+from DicomPixelAnon.rectlist import RectList
 from DicomPixelAnon.nerengine import NER
 from DicomPixelAnon.ocrenum import OCREnum
 from DicomPixelAnon.nerenum import NEREnum
@@ -241,13 +242,9 @@ def redact_rectangles_from_high_bit_overlay(ds, overlay=0, rect_list=None):
     # Can't simply &=bit_mask if dtype differs so use 1-elem array.
     bit_mask_arr = np.array([bit_mask], dtype=pixel_data.dtype)
 
-    for rect in rect_list:
-        x0, y0, w, h = rect
-        if x0 < 0 or y0 < 0 or w < 1 or h < 1:
-            continue
-        x1 = x0 + w
-        y1 = y0 + h
-        pixel_data[y0:y1, x0:x1] &= bit_mask_arr
+    # The mask applies to every frame if there are several
+    mask = rect_list_to_mask(rect_list, pixel_data.shape[-2], pixel_data.shape[-1])
+    np.bitwise_and(pixel_data, bit_mask_arr, out=pixel_data, where=mask)
 
     # Set the pixel data from the numpy array
     # XXX Should use set_pixel_data() ?
@@ -258,24 +255,50 @@ def redact_rectangles_from_high_bit_overlay(ds, overlay=0, rect_list=None):
     return
 
 
+def rect_list_to_mask(rect_list, rows, cols):
+    """ Return a boolean array (rows, cols) which is True inside any of
+    the rectangles in the list of (x0,y0,w,h). Rectangles with negative
+    coordinates or no area are ignored.
+    """
+    rects = [rect for rect in rect_list if not (rect[0] < 0 or rect[1] < 0 or rect[2] < 1 or rect[3] < 1)]
+    if not rects:
+        return np.zeros((rows, cols), dtype=bool)
+    x0, y0, w, h = np.array(rects, dtype=np.int64).T
+    return RectList.from_arrays(top=y0, bottom=y0+h-1, left=x0, right=x0+w-1).mask(rows, cols)
+
+
 def redact_rectangles_from_image_frame(ds, frame=0, rect_list=None):
     """ Redact a list of rectangles (x0,y0,w,h) from a specific image frame,
     counting from zero.
     """
     if not rect_list:
         rect_list = []
+    return redact_rectangles_from_image_frames(ds, { frame: rect_list })
+
 
+def redact_rectangles_from_image_frames(ds, frame_rect_lists):
+    """ Redact rectangles from several image frames at once, given a
+    dict mapping frame number (counting from zero) to a list of
+    rectangles (x0,y0,w,h). Frame -1 means all frames.
+    The pixel data is decoded and stored only once, each list is turned
+    into a mask and the mask for all frames is applied to the whole
+    stack of frames in one operation.
+    """
     samples = ds['SamplesPerPixel'].value if 'SamplesPerPixel' in ds else -1
     photometric = ds['PhotometricInterpretation'].value if 'PhotometricInterpretation' in ds else 'MONOCHROME2'
     num_frames = ds['NumberOfFrames'].value if 'NumberOfFrames' in ds else 1
     bits_stored = ds['BitsStored'].value if 'BitsStored' in ds else -1
-    logger.debug('redact_rectangles_from_image_frame: frame=%d, num_frames=%d, samples=%d, photometric=%s, bits_stored=%d' % (frame, num_frames, samples, photometric, bits_stored))
+    logger.debug('redact_rectangles_from_image_frames: frames=%s, num_frames=%d, samples=%d, photometric=%s, bits_stored=%d' % (sorted(frame_rect_lists), num_frames, samples, photometric, bits_stored))
 
     # Calculate mask to set pixel to black without breaking high bit overlays
     bit_mask = np.array(0xffff << bits_stored).astype(np.uint16)
 
-    if frame >= num_frames:
-        logger.error('cannot redact frame %d, max is %d' % (frame, num_frames-1))
+    for frame in sorted(frame_rect_lists):
+        if frame >= num_frames:
+            logger.error('cannot redact frame %d, max is %d' % (frame, num_frames-1))
+    frame_rect_lists = { frame: rect_list for frame, rect_list in frame_rect_lists.items()
+        if rect_list and frame < num_frames }
+    if not frame_rect_lists:
         return
 
     pixel_data = ds.pixel_array # this can raise an exception in some files
@@ -294,24 +317,23 @@ def redact_rectangles_from_image_frame(ds, frame=0, rect_list=None):
     # Can't simply &=bit_mask if dtype differs so use 1-elem array.
     bit_mask_arr = np.array([bit_mask], dtype=pixel_data.dtype)
 
-    for rect in rect_list:
-        x0, y0, w, h = rect
-        if x0 < 0 or y0 < 0 or w < 1 or h < 1:
-            continue
-        x1 = x0 + w
-        y1 = y0 + h
-        if pixel_data.ndim == 2:
-            pixel_data[y0:y1, x0:x1] &= bit_mask_arr
-        elif pixel_data.ndim == 3 and (samples == 3 or photometric == 'RGB'):
-            # XXX assumes the colour channel is the last element
-            pixel_data[y0:y1, x0:x1, :] &= bit_mask_arr
-        elif pixel_data.ndim == 3:
-            # XXX assumes the frame channel is the first element
-            pixel_data[frame, y0:y1, x0:x1] &= bit_mask_arr
-        elif pixel_data.ndim == 4:
-            # XXX assumes the frame channel is the first element
+    # Make a view of the pixels as a stack of frames, with the colour
+    # channel (if any) last, so a 2D mask broadcasts across the stack.
+    is_colour = (pixel_data.ndim == 3 and (samples == 3 or photometric == 'RGB')) or pixel_data.ndim == 4
+    if pixel_data.ndim == 2 or (pixel_data.ndim == 3 and is_colour):
+        stack = pixel_data[np.newaxis]
+    else:
+        # XXX assumes the frame channel is the first element
+        stack = pixel_data
+    rows, cols = stack.shape[1], stack.shape[2]
+
+    for frame, rect_list in frame_rect_lists.items():
+        mask = rect_list_to_mask(rect_list, rows, cols)
+        if is_colour:
             # XXX assumes the colour channel is the last element
-            pixel_data[frame, y0:y1, x0:x1, :] &= bit_mask_arr
+            mask = mask[..., np.newaxis]
+        target = stack if frame == -1 or stack.shape[0] == 1 else stack[frame]
+        np.bitwise_and(target, bit_mask_arr, out=target, where=mask)
 
     # Set the pixel data from the numpy array
     #ds.PixelData = pixel_data.tobytes() photometric_interpretation="RGB"
@@ -337,16 +359,11 @@ def redact_rectangles_from_overlay_frame(ds, frame=0, overlay=0, rect_list=None)
 
     pixel_data = ds.overlay_array(overlay_group_num)
 
-    for rect in rect_list:
-        x0, y0, w, h = rect
-        x1 = x0 + w
-        y1 = y0 + h
-        if x0 < 0 or y0 < 0 or w < 1 or h < 1:
-            continue
-        if pixel_data.ndim == 2:
-            pixel_data[y0:y1, x0:x1] = redacted_colour
-        else:
-            pixel_data[frame, y0:y1, x0:x1] = redacted_colour
+    mask = rect_list_to_mask(rect_list, pixel_data.shape[-2], pixel_data.shape[-1])
+    if pixel_data.ndim == 2:
+        pixel_data[mask] = redacted_colour
+    else:
+        pixel_data[frame][mask] = redacted_colour
 
     packed_bytes = pack_bits(pixel_data)
 
@@ -378,21 +395,9 @@ def redact_rectangles(ds, frame=-1, overlay=-1, rect_list=None):
 
     # Redact all frames, all overlays, all frames in overlays
     if overlay == -1 and frame == -1:
-        num_frames = ds['NumberOfFrames'].value if 'NumberOfFrames' in ds else 1
         # Redact all the frames
-        for framen in range(num_frames):
-            redact_rectangles_from_image_frame(ds, framen, rect_list)
-        # Redact all the high-bit overlays (if any)
-        for overlay_num in range(16):
-            if overlay_bit_position(ds, overlay_num) > 0:
-                redact_rectangles_from_high_bit_overlay(ds, overlay_num, rect_list)
-        # Redact all the frames in all the overlays
-        for overlay_num in range(16):
-            overlay_group_num = overlay_tag_group_from_index(overlay_num)
-            if [overlay_group_num, elem_OverlayData] in ds:
-                # Redact the first frame in this overlay
-                redact_rectangles_from_overlay_frame(ds, 0, overlay_num, rect_list)
-                # XXX not yet implemented - does not redact ALL frames in this overlay
+        redact_rectangles_from_image_frames(ds, { -1: rect_list })
+        redact_rectangles_from_all_overlays(ds, rect_list)
         return None
 
     # Only a single frame
@@ -412,6 +417,24 @@ def redact_rectangles(ds, frame=-1, overlay=-1, rect_list=None):
     return redact_rectangles_from_overlay_frame(ds, frame, overlay, rect_list)
 
 
+def redact_rectangles_from_all_overlays(ds, rect_list):
+    """ Redact a list of rectangles (x0,y0,w,h) from all the overlays,
+    both those in the high bits of the image and separate overlays.
+    """
+    # Redact all the high-bit overlays (if any)
+    for overlay_num in range(16):
+        if overlay_bit_position(ds, overlay_num) > 0:
+            redact_rectangles_from_high_bit_overlay(ds, overlay_num, rect_list)
+    # Redact all the frames in all the overlays
+    for overlay_num in range(16):
+        overlay_group_num = overlay_tag_group_from_index(overlay_num)
+        if [overlay_group_num, elem_OverlayData] in ds:
+            # Redact the first frame in this overlay
+            redact_rectangles_from_overlay_frame(ds, 0, overlay_num, rect_list)
+            # XXX not yet implemented - does not redact ALL frames in this overlay
+    return None
+
+
 # ---------------------------------------------------------------------
 # Functions to implement an allow-list for letting through rectangles
 # whose text exactly matches a pattern.
@@ -493,18 +516,57 @@ def redact_DicomRect_rectangles(ds, dicomrect_list):
     pydicom.dataset.Dataset object (from dcmread).
     The list may contain rectangles from any frame,overlay, so it
     splits the list by frame/overlay and call redact_rectangles
-    on each grouping.
+    on each grouping. All the image frames are redacted together so
+    the pixel data is only decoded once.
     """
     frameoverlay_list = [(dr.F(), dr.O()) for dr in dicomrect_list]
     frameoverlay_set = set(frameoverlay_list) # to get unique values
-    for (frame,overlay) in frameoverlay_set:
+    frame_rect_lists = {}
+    for (frame,overlay) in sorted(frameoverlay_set):
         # convert from corner coord to width,height
         rect_list = [ (dr.L(), dr.T(), 1+dr.R()-dr.L(), 1+dr.B()-dr.T())
             for dr in dicomrect_list if dr.F() == frame and dr.O() == overlay]
         # Remove rect which are safe (in the allowlist)
         rect_list = filter_rect_list(rect_list)
+        if not rect_list:
+            continue
         # Perform the redaction on the pydicom dataset
-        redact_rectangles(ds, frame=frame, overlay=overlay, rect_list=rect_list)
+        if overlay == -1:
+            frame_rect_lists[frame] = rect_list
+            if frame == -1 and 'PixelData' in ds:
+                redact_rectangles_from_all_overlays(ds, rect_list)
+        else:
+            redact_rectangles(ds, frame=frame, overlay=overlay, rect_list=rect_list)
+    if frame_rect_lists:
+        if not 'PixelData' in ds:
+            logger.error('redact_DicomRect_rectangles: no pixel data present')
+            return
+        redact_rectangles_from_image_frames(ds, frame_rect_lists)
+
+
+def test_redact_DicomRect_rectangles():
+    """ Check the masks give the same result as redacting each rectangle """
+    from pydicom.dataset import Dataset, FileMetaDataset
+    from pydicom.uid import ExplicitVRLittleEndian
+    rng = np.random.default_rng(1)
+    pixels = rng.integers(1, 0x1000, size=(3, 40, 50), dtype=np.uint16)
+    ds = Dataset()
+    ds.file_meta = FileMetaDataset()
+    ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds.set_pixel_data(pixels.copy(), photometric_interpretation='MONOCHROME2', bits_stored=12)
+    dicomrect_list = [
+        DicomRect(top=1, bottom=5, left=2, right=9, frame=-1),
+        DicomRect(top=30, bottom=60, left=45, right=70, frame=-1),
+        DicomRect(top=10, bottom=12, left=10, right=12, frame=1),
+        DicomRect(top=-1, bottom=-1, left=-1, right=-1, frame=2),
+    ]
+    redact_DicomRect_rectangles(ds, dicomrect_list)
+    expected = pixels.copy()
+    for frame in range(3):
+        expected[frame, 1:6, 2:10] &= 0xf000
+        expected[frame, 30:61, 45:71] &= 0xf000
+    expected[1, 10:13, 10:13] &= 0xf000
+    assert (ds.pixel_array == expected).all()
 
 
 # ---------------------------------------------------------------------
@@ -581,7 +643,7 @@ def read_filenames_from_database(db_dir = None, filter_filename = None):
     if db_dir:
         DicomRectDB.set_db_path(db_dir)
     db = DicomRectDB()
-    db_files = db.query_rect_filenames(filter_filename = filename)
+    db_files = db.query_rect_filenames(filter_filename = filter_filename)
     return db_files
 
 
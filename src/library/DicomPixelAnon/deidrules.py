@@ -163,11 +163,11 @@ def test_deid_result_rectangles():
     # We are expected 3 rectangles which cover the inverse
     # of the regions listed in the results because they are
     # type 1 (meaning keep) from Ultrasound.
-    assert(len(rectlist) == 6)
-    assert('<DicomRect frame=-1 overlay=-1 0,0->639,24>' in rectlist_str)
-    assert('<DicomRect frame=-1 overlay=-1 0,24->32,415>' in rectlist_str)
-    assert('<DicomRect frame=-1 overlay=-1 335,24->336,415>' in rectlist_str)
-    assert('<DicomRect frame=-1 overlay=-1 0,415->639,479>' in rectlist_str)
+    # The two keep regions 32..335 and 336..639 adjoin so leave no gap.
+    assert(len(rectlist) == 5)
+    assert('<DicomRect frame=-1 overlay=-1 0,0->639,23>' in rectlist_str)
+    assert('<DicomRect frame=-1 overlay=-1 0,24->31,415>' in rectlist_str)
+    assert('<DicomRect frame=-1 overlay=-1 0,416->639,479>' in rectlist_str)
     assert('<DicomRect frame=-1 overlay=-1 33,34->35,36>' in rectlist_str)
     assert('<DicomRect frame=-1 overlay=-1 41,42->43,44>' in rectlist_str)
 
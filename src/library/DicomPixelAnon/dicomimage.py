@@ -159,6 +159,7 @@ class DicomImage:
         NB. ManufacturerModelName is now Manufacturer + SoftwareVersions
           if the ModelName is missing, or NoModel if both those are missing
           (changed 2022-08-28).
+        SOPInstanceUID is stored in the DicomRectDB 'Files' table.
         """
         return {
             "Modality": self.ds.get('Modality', 'NoModality'),
@@ -167,6 +168,7 @@ class DicomImage:
             "Columns": int(self.ds.get('Columns', 0)),
             "ManufacturerModelName": self.get_tag_manufacturer_model(),
             "BurnedInAnnotation": self.ds.get('BurnedInAnnotation','NoBIA'),
+            "SOPInstanceUID": self.ds.get('SOPInstanceUID', ''),
         }
 
     def debug_tags(self):
@@ -0,0 +1,184 @@
+""" The NERCache class memoises the results of NER on a text string,
+used by the NER class because OCR output is very repetitive.
+It keeps an in-memory LRU cache and optionally a SQLite database
+on disk which can be shared between worker processes.
+"""
+# Every entry is keyed by a signature (engine, model, version and a
+# digest of the engine data such as the allowlist file) plus the text,
+# so a changed allowlist or model version never returns a stale verdict.
+# The on-disk store is only a cache so any database errors are logged
+# and treated as a cache miss. It is shared between worker processes so
+# every write is committed straight away in a short transaction, never
+# holding the write lock while NER runs, and a writer only waits
+# busy_timeout seconds for the lock before giving up on that write.
+
+import json
+import logging
+import sqlite3
+from collections import OrderedDict
+
+
+class NERCache:
+    """ An LRU memo of text -> list of entities for one NER signature,
+    optionally backed by a SQLite database file.
+    """
+    # Seconds to wait for another process to release the database lock
+    busy_timeout = 1.0
+
+    def __init__(self, signature, maxsize = 65536, filename = None):
+        """ signature is a tuple or list identifying the NER engine,
+        model, version, etc., which must be JSON serialisable.
+        maxsize is the number of entries kept in memory (0 for none).
+        filename is an optional SQLite database file.
+        """
+        self.signature = json.dumps(list(signature))
+        self.maxsize = maxsize
+        self.filename = filename
+        self.hits = 0
+        self.misses = 0
+        self._memo = OrderedDict()
+        self._db = None
+        if filename:
+            try:
+                # isolation_level None means each statement commits itself
+                self._db = sqlite3.connect(filename, timeout = NERCache.busy_timeout,
+                    isolation_level = None)
+                self._db.execute('PRAGMA journal_mode=WAL')
+                self._db.execute('PRAGMA synchronous=NORMAL')
+                self._db.execute('CREATE TABLE IF NOT EXISTS NERCache ('
+                    'signature TEXT, text TEXT, entities TEXT, '
+                    'PRIMARY KEY (signature, text))')
+            except sqlite3.Error as e:
+                logging.warning('cannot use NER cache %s (%s)' % (filename, e))
+                self._db = None
+
+    def __del__(self):
+        self.close()
+
+    def __repr__(self):
+        return '<NERCache %s %d entries, %d hits, %d misses%s>' % (self.signature,
+            len(self._memo), self.hits, self.misses,
+            (' in %s' % self.filename) if self._db else '')
+
+    def __len__(self):
+        return len(self._memo)
+
+    def get(self, text):
+        """ Return the cached list of entities for the text,
+        or None if not in the cache.
+        """
+        if text in self._memo:
+            self._memo.move_to_end(text)
+            self.hits += 1
+            return self._memo[text]
+        if self._db:
+            try:
+                row = self._db.execute('SELECT entities FROM NERCache WHERE signature = ? AND text = ?',
+                    (self.signature, text)).fetchone()
+            except sqlite3.Error as e:
+                logging.warning('cannot read NER cache %s (%s)' % (self.filename, e))
+                row = None
+            if row:
+                self.hits += 1
+                entities = json.loads(row[0])
+                self._remember(text, entities)
+                return entities
+        self.misses += 1
+        return None
+
+    def put(self, text, entities):
+        """ Store the list of entities for the text.
+        """
+        self.put_many([(text, entities)])
+
+    def put_many(self, text_entities):
+        """ Store a list of (text, list of entities), written to the
+        database file in a single short transaction.
+        """
+        text_entities = list(text_entities)
+        for text, entities in text_entities:
+            self._remember(text, entities)
+        if self._db and text_entities:
+            try:
+                self._db.execute('BEGIN IMMEDIATE')
+                try:
+                    self._db.executemany('INSERT OR REPLACE INTO NERCache (signature, text, entities) VALUES (?, ?, ?)',
+                        [ (self.signature, text, json.dumps(entities)) for text, entities in text_entities ])
+                    self._db.execute('COMMIT')
+                except sqlite3.Error:
+                    self._db.execute('ROLLBACK')
+                    raise
+            except sqlite3.Error as e:
+                logging.warning('cannot write NER cache %s (%s)' % (self.filename, e))
+
+    def _remember(self, text, entities):
+        """ Add to the in-memory LRU, discarding the oldest if full.
+        """
+        if self.maxsize <= 0:
+            return
+        self._memo[text] = entities
+        self._memo.move_to_end(text)
+        while len(self._memo) > self.maxsize:
+            self._memo.popitem(last = False)
+
+    def clear(self):
+        """ Forget all entries for this signature, in memory and on disk.
+        """
+        self._memo.clear()
+        if self._db:
+            self._db.execute('DELETE FROM NERCache WHERE signature = ?', (self.signature,))
+
+    def close(self):
+        """ Close the database file.
+        """
+        if getattr(self, '_db', None):
+            self._db.close()
+            self._db = None
+
+
+def test_NERCache(tmpdir):
+    import os
+    dbfile = os.path.join(tmpdir, 'nercache.db')
+    cache = NERCache(('ocr_allowlist', 'model', '1.0.0', 'abc'), maxsize = 2, filename = dbfile)
+    assert cache.get('AP ERECT') is None
+    cache.put('AP ERECT', [])
+    cache.put('NOT ERECT', [{'text': 'NOT ERECT', 'label': 'MISC'}])
+    assert cache.get('AP ERECT') == []
+    cache.put('PA', [])
+    assert len(cache) == 2 # NOT ERECT was least recently used
+    assert (cache.hits, cache.misses) == (1, 1)
+    cache.close()
+    # Another worker sees the entries on disk
+    cache2 = NERCache(('ocr_allowlist', 'model', '1.0.0', 'abc'), filename = dbfile)
+    assert cache2.get('NOT ERECT') == [{'text': 'NOT ERECT', 'label': 'MISC'}]
+    # but not if the signature changes, e.g. the allowlist was edited
+    cache3 = NERCache(('ocr_allowlist', 'model', '1.0.0', 'def'), filename = dbfile)
+    assert cache3.get('NOT ERECT') is None
+    cache2.clear()
+    assert cache2.get('PA') is None
+
+
+def test_NERCache_shared(tmpdir):
+    import os
+    import time
+    dbfile = os.path.join(tmpdir, 'nercache.db')
+    cache1 = NERCache(('ocr_allowlist', 'model', '1.0.0', 'abc'), filename = dbfile)
+    cache2 = NERCache(('ocr_allowlist', 'model', '1.0.0', 'abc'), filename = dbfile)
+    # Each write is committed so neither process waits for the other
+    start = time.perf_counter()
+    cache1.put('AP ERECT', [])
+    cache2.put('PA ERECT', [])
+    cache1.put_many([('NOT ERECT', [{'text': 'NOT ERECT', 'label': 'MISC'}]), ('LAT', [])])
+    assert time.perf_counter() - start < NERCache.busy_timeout
+    assert cache2.get('AP ERECT') == []
+    assert cache2.get('LAT') == []
+    assert cache1.get('PA ERECT') == []
+    assert (cache2.misses, cache1.misses) == (0, 0)
+    # A process holding the lock only delays a write by busy_timeout
+    blocker = sqlite3.connect(dbfile, isolation_level = None)
+    blocker.execute('BEGIN IMMEDIATE')
+    start = time.perf_counter()
+    cache1.put('CHEST', [])
+    assert time.perf_counter() - start < NERCache.busy_timeout + 1
+    blocker.execute('ROLLBACK')
+    assert cache1.get('CHEST') == [] # still remembered in memory
@@ -12,6 +12,7 @@ allowing NER to be run on text to find possible PII.
 #  no arguments, runs through a set of test strings
 #  argument: tests each NER with the given string
 
+import hashlib
 import logging
 import os
 import re
@@ -19,32 +20,63 @@ import sys
 from pathlib import Path
 from importlib.util import find_spec
 from DicomPixelAnon.nerenum import NEREnum
-
-# Try to import spacy
-try:
-    import spacy
-except:
-    pass
-
-# Try to import flair
-try:
-    import flair
-    from flair.data import Sentence
-    from flair.models import SequenceTagger
-except:
-    pass
-
-# Try to import stanford
-try:
-    import stanford_ner
-except:
-    pass
-
-# Try to import the new Stanford
-try:
-    import stanza
-except:
-    pass
+from DicomPixelAnon.regexindex import RegexIndex
+from DicomPixelAnon.nercache import NERCache
+
+# The NER libraries are only imported when an engine using them is
+# constructed, see _import_backend(), because some take several seconds
+# to import (e.g. flair imports torch and transformers) and are not
+# needed when only the ocr_allowlist is used.
+spacy = None
+flair = None
+Sentence = None
+SequenceTagger = None
+stanford_ner = None
+stanza = None
+
+def _import_backend(engine):
+    """ Import the library needed by the given engine name into the
+    module globals, if not already imported.
+    Returns False if the library is not available.
+    """
+    global spacy, flair, Sentence, SequenceTagger, stanford_ner, stanza
+    try:
+        if engine == 'spacy' and not spacy:
+            import spacy
+        elif engine == 'flair' and not flair:
+            from flair.data import Sentence
+            from flair.models import SequenceTagger
+            import flair
+        elif engine == 'stanford' and not stanford_ner:
+            try:
+                from DicomPixelAnon import stanford_ner
+            except ImportError:
+                import stanford_ner
+        elif engine == 'stanza' and not stanza:
+            import stanza
+    except Exception as e:
+        logging.debug('cannot import library for %s (%s)' % (engine, e))
+        return False
+    return True
+
+
+def data_signature(path):
+    """ Return a digest of the names, sizes and modification times of
+    all the files under the path (a file or directory), so that it
+    changes if the model data is replaced, or '' if path is None.
+    """
+    if not path:
+        return ''
+    digest = hashlib.sha1()
+    paths = [ path ] if os.path.isfile(path) else sorted(
+        os.path.join(root, name) for root, _, files in os.walk(path) for name in files)
+    for filename in paths:
+        try:
+            st = os.stat(filename)
+        except OSError:
+            continue
+        digest.update(('%s %d %d\n' % (os.path.relpath(filename, path), st.st_size, int(st.st_mtime))).encode())
+    return digest.hexdigest()
 
 
 class NER():
@@ -57,7 +89,27 @@ class NER():
     the OCR output from a set of CR and DX images which identify
     safe text, not PII text. The others are language models
     (which typically require some textual context to determine PII).
+    The results of detect() are memoised, see set_memo().
     """
+    # Class static variables configuring the memo of detect() results.
+    # Set the values using set_memo(size, filename).
+    memo_size = 65536
+    memo_filename = None
+    # Class static variables giving the default batch size for detect_batch()
+    # and the number of processes used by spacy in detect_batch().
+    batch_size = 64
+    n_process = 1
+
+    @staticmethod
+    def set_memo(size = None, filename = None):
+        """ Set the class-static number of detect() results remembered
+        in memory by each NER object (0 to disable), and the filename
+        of an optional SQLite database to share results between processes.
+        Note that this affects all NER objects subsequently constructed.
+        """
+        if size is not None:
+            NER.memo_size = size
+        NER.memo_filename = filename
 
     @staticmethod
     def spacy_entity_map(entity : str):
@@ -116,9 +168,11 @@ class NER():
         self._engine_enum = 0
         self.engine_model = 'undefined'
         self.engine_version = '0.0'
+        self.engine_data_signature = '' # changes if the model data changes
+        self._memo = None
 
         if engine == 'spacy':
-            if 'spacy' not in sys.modules:
+            if not _import_backend('spacy'):
                 logging.error('spacy requested but not available')
                 return
             self._engine_enum = 10
@@ -137,11 +191,12 @@ class NER():
             #self.engine_data_dir = os.path.join(os.environ.get('SMI_ROOT'), 'data', 'spacy_'+self.engine_version) # not needed yet
             logging.debug('Loading %s version %s with %s' % (self._engine_name, self.engine_version, model))
             self.nlp = spacy.load(model)
+            self.engine_data_signature = self.nlp.meta.get('version', '')
             # Mark this object as valid by updating value of model
             self.engine_model = model
 
         elif engine == 'flair':
-            if 'flair' not in sys.modules:
+            if not _import_backend('flair'):
                 logging.error('flair requested but not available')
                 return
             self._engine_enum = NEREnum.flair
@@ -164,11 +219,12 @@ class NER():
             flair.cache_root = Path(self.engine_data_dir)
             logging.debug('Loading %s version %s with %s from %s' % (self._engine_name, self.engine_version, model, self.engine_data_dir))
             self.tagger = SequenceTagger.load(model)
+            self.engine_data_signature = data_signature(model if os.path.isfile(model) else self.engine_data_dir)
             # Mark this object as valid by updating value of model
             self.engine_model = model
 
         elif engine == 'stanford':
-            if 'stanford_ner' not in sys.modules:
+            if not _import_backend('stanford'):
                 logging.error('stanford_ner requested but not available')
                 return
             self._engine_name = engine
@@ -188,12 +244,13 @@ class NER():
             if not self.engine_data_dir:
                 logging.error('stanford_ner requested but no data directory found')
                 return
+            self.engine_data_signature = data_signature(self.engine_data_dir)
             # Mark this object as valid by updating value of model
             self.engine_model = model
             logging.debug('Loading %s version %s with %s from %s' % (self._engine_name, self.engine_version, self.engine_model, self.engine_data_dir))
 
         elif engine == 'stanza':
-            if 'stanza' not in sys.modules:
+            if not _import_backend('stanza'):
                 logging.error('stanza requested but not available')
                 return
             self._engine_name = engine
@@ -214,6 +271,7 @@ class NER():
                 processors='tokenize,ner',
                 download_method=None,
                 dir=self.engine_data_dir)
+            self.engine_data_signature = data_signature(self.engine_data_dir)
             # Mark this object as valid by updating value of model
             self.engine_model = model
 
@@ -241,8 +299,12 @@ class NER():
                 logging.error('ocr_allowlist requested but no data file found (%s)' % ocr_allowlist_file)
                 return
             self.ocr_allowlist_regex_list = []
+            with open(ocr_allowlist_file, 'rb') as fd:
+                self.engine_data_signature = hashlib.sha1(fd.read()).hexdigest()
             with open(ocr_allowlist_file) as fd:
                 self.ocr_allowlist_regex_list = [re.compile(line.strip()) for line in fd.readlines()]
+            # Index the regexes by their literal text so only a few are run
+            self.ocr_allowlist_index = RegexIndex(self.ocr_allowlist_regex_list)
             # Mark this object as valid by updating value of model
             self.engine_model = model
 
@@ -269,49 +331,138 @@ class NER():
         """
         return self._engine_enum
 
+    def _get_memo(self):
+        """ Return the NERCache for this object, or None if not memoising.
+        """
+        if not self.isValid() or not (NER.memo_size or NER.memo_filename):
+            return None
+        if self._memo is None:
+            self._memo = NERCache((self._engine_name, self.engine_model,
+                self.engine_version, self.engine_data_signature),
+                maxsize = NER.memo_size, filename = NER.memo_filename)
+        return self._memo
+
     def detect(self, text):
         """ Detect PII in the text and return a list of entites,
         where each entity is a dict {'text': the text, 'label': entity type}
         where the types are 'PER', 'LOC', 'ORG', 'MISC' only.
         Returns empty list if nothing detected.
+        Results are remembered so repeated text is not processed again.
+        """
+        memo = self._get_memo()
+        if memo is None:
+            return self._detect(text) or []
+        entities_list = memo.get(text)
+        if entities_list is None:
+            entities_list = self._detect(text)
+            if entities_list is None:
+                return []
+            memo.put(text, entities_list)
+        # Return a copy so the caller cannot modify the memo
+        return [dict(e) for e in entities_list]
+
+    def detect_batch(self, texts, batch_size = None, n_process = None):
+        """ As detect() but for a list of texts, returning a list of
+        lists of entities, one for each text. This is much faster than
+        calling detect() for each text because the language models can
+        process many texts at once. Texts which have been seen before
+        (or are repeated in the list) are only processed once.
+        batch_size is the number of texts per batch (default NER.batch_size)
+        and n_process is the number of processes used by spacy (default NER.n_process).
+        """
+        batch_size = batch_size or NER.batch_size
+        n_process = n_process or NER.n_process
+        memo = self._get_memo()
+        results = {}
+        if memo is not None:
+            for text in texts:
+                if text not in results:
+                    entities_list = memo.get(text)
+                    if entities_list is not None:
+                        results[text] = entities_list
+        todo = list(dict.fromkeys(text for text in texts if text not in results))
+        if todo:
+            for text, entities_list in zip(todo, self._detect_batch(todo, batch_size, n_process)):
+                results[text] = entities_list
+            # The whole batch is saved in one transaction
+            if memo is not None:
+                memo.put_many((text, results[text]) for text in todo if results[text] is not None)
+        return [ [dict(e) for e in results[text] or []] for text in texts ]
+
+    def _spacy_entities(self, doc):
+        # en_core_web_sm/md/lg/trf has DATE,GPE,ORG,PERSON, etc
+        # scispacy has others.
+        return [ {'text':e.text, 'label':NER.spacy_entity_map(e.label_)}
+            for e in doc.ents if NER.spacy_entity_map(e.label_) ]
+
+    def _flair_entities(self, sentence):
+        # ner-english has 4 classes: PER,LOC,ORG,MISC
+        return [ {'text':e.text, 'label':NER.flair_entity_map(e.get_label('ner').value)}
+            for e in sentence.get_spans('ner') if NER.flair_entity_map(e.get_label('ner').value) ]
+
+    def _stanford_entities(self, entities):
+        # Given [ ['str','CLASS'], ... ]
+        return [ {'text':e[0], 'label':NER.stanford_entity_map(e[1])}
+            for e in entities if NER.stanford_entity_map(e[1]) ]
+
+    def _stanza_entities(self, doc):
+        return [ {'text':e.text, 'label':NER.stanford_entity_map(e.type)}
+            for e in doc.entities if NER.stanza_entity_map(e.type) ]
+
+    def _allowlist_entities(self, text):
+        # Return the whole string as a MISC entity if it's not in the allowlist
+        entities_list = [ {'text': text, 'label': 'MISC'} ]
+        # Use fullmatch to ensure whole string matches pattern
+        if self.ocr_allowlist_index.fullmatch(text):
+            entities_list = []
+        return entities_list
+
+    def _detect(self, text):
+        """ Perform detect() without using the memo.
+        Returns None if the engine failed, so the result is not remembered.
         """
         if self._engine_name == 'spacy':
-            entities = self.nlp(text).ents
-            # en_core_web_sm/md/lg/trf has DATE,GPE,ORG,PERSON, etc
-            # scispacy has others.
-            entities_list = [ {'text':e.text, 'label':NER.spacy_entity_map(e.label_)}
-                for e in entities if NER.spacy_entity_map(e.label_) ]
-            return entities_list
+            return self._spacy_entities(self.nlp(text))
         elif self._engine_name == 'flair':
             sentence = Sentence(text)
             self.tagger.predict(sentence)
-            entities = sentence.get_spans('ner')
-            # ner-english has 4 classes: PER,LOC,ORG,MISC
-            entities_list = [ {'text':e.text, 'label':NER.flair_entity_map(e.get_label('ner').value)}
-                for e in entities if NER.flair_entity_map(e.get_label('ner').value) ]
-            return entities_list
+            return self._flair_entities(sentence)
         elif self._engine_name == 'stanford':
-            # Returns [ ['str','CLASS'], ... ]
-            entities = stanford_ner.stanford_ner(text, verbose=False, stanford_dir=os.path.abspath(self.engine_data_dir))
-            entities_list = [ {'text':e[0], 'label':NER.stanford_entity_map(e[1])}
-                for e in entities if NER.stanford_entity_map(e[1]) ]
-            return entities_list
+            return self._detect_batch([text], 1, 1)[0]
         elif self._engine_name == 'stanza':
-            entities = self.stanza_nlp(text).entities
-            entities_list = [ {'text':e.text, 'label':NER.stanford_entity_map(e.type)}
-                for e in entities if NER.stanza_entity_map(e.type) ]
-            return entities_list
+            return self._stanza_entities(self.stanza_nlp(text))
         elif self._engine_name == 'ocr_allowlist':
-            # Return the whole string as a MISC entity if it's not in the allowlist
-            entities_list = [ {'text': text, 'label': 'MISC'} ]
-            for pattern in self.ocr_allowlist_regex_list:
-                # Use fullmatch to ensure whole string matches pattern
-                if pattern.fullmatch(text):
-                    entities_list = []
-                    break
-            return entities_list
+            return self._allowlist_entities(text)
         return []
 
+    def _detect_batch(self, texts, batch_size, n_process):
+        """ Perform detect_batch() without using the memo.
+        The result for a text is None if the engine failed.
+        """
+        if self._engine_name == 'spacy':
+            return [ self._spacy_entities(doc)
+                for doc in self.nlp.pipe(texts, batch_size = batch_size, n_process = n_process) ]
+        elif self._engine_name == 'flair':
+            # flair cannot handle empty sentences
+            sentences = [ Sentence(text) for text in texts ]
+            nonempty = [ sentence for sentence in sentences if len(sentence) ]
+            if nonempty:
+                self.tagger.predict(nonempty, mini_batch_size = batch_size)
+            return [ self._flair_entities(sentence) for sentence in sentences ]
+        elif self._engine_name == 'stanford':
+            try:
+                return [ self._stanford_entities(entities)
+                    for entities in stanford_ner.stanford_ner_server(self.engine_data_dir).classify_batch(texts) ]
+            except RuntimeError as e:
+                logging.error('stanford_ner failed: %s' % e)
+                return [ None for text in texts ]
+        elif self._engine_name == 'stanza':
+            # stanza processes a list of Documents together
+            docs = self.stanza_nlp([ stanza.Document([], text=text) for text in texts ])
+            return [ self._stanza_entities(doc) for doc in docs ]
+        elif self._engine_name == 'ocr_allowlist':
+            return [ self._allowlist_entities(text) for text in texts ]
+        return [ [] for text in texts ]
 
 def test_spacy():
     ner = NER('spacy')
@@ -328,6 +479,26 @@ def test_stanford():
     assert ner.isValid()
     assert ner.detect('Queen Elizabeth Hospital') == [{'label': 'LOC', 'text': 'Queen Elizabeth Hospital'}]
 
+def test_import_time():
+    """ Check that importing this module does not import any of the
+    NER libraries and stays within a time budget (microseconds).
+    """
+    import subprocess
+    budget = 500000
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([
+        os.path.join(os.path.dirname(__file__), '..'), os.environ.get('PYTHONPATH', '')]))
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import DicomPixelAnon.nerengine'],
+        env=env, capture_output=True, text=True, check=True)
+    # Lines are: import time: self [us] | cumulative | imported package
+    imported = {}
+    for line in proc.stderr.splitlines():
+        fields = line.split('|')
+        if line.startswith('import time:') and len(fields) == 3 and fields[1].strip().isdigit():
+            imported[fields[2].strip()] = int(fields[1])
+    for backend in ['spacy', 'flair', 'stanza', 'torch', 'transformers']:
+        assert backend not in imported
+    assert imported['DicomPixelAnon.nerengine'] < budget
+
 def test_ocr_allowlist():
     ner = NER('ocr_allowlist')
     assert ner.isValid()
@@ -335,6 +506,64 @@ def test_ocr_allowlist():
     assert ner.detect('AP ERECT') == []
     assert ner.detect('NOT ERECT') == [{'label': 'MISC', 'text': 'NOT ERECT'}]
 
+def test_ocr_allowlist_memo(tmpdir):
+    NER.set_memo(filename = os.path.join(tmpdir, 'nercache.db'))
+    ner = NER('ocr_allowlist')
+    assert ner.detect('NOT ERECT') == [{'label': 'MISC', 'text': 'NOT ERECT'}]
+    assert ner.detect('NOT ERECT') == [{'label': 'MISC', 'text': 'NOT ERECT'}]
+    assert ner.detect('AP ERECT') == []
+    assert (ner._memo.hits, ner._memo.misses) == (1, 2)
+    # A second NER object reads the results from the database
+    ner2 = NER('ocr_allowlist')
+    ner2.detect('AP ERECT')
+    assert (ner2._memo.hits, ner2._memo.misses) == (1, 0)
+    NER.set_memo(filename = None)
+
+def test_memo_kept_when_empty(tmpdir):
+    """ An empty memo must not be replaced by a new one (NERCache has
+    a __len__ so an empty one is falsy) which would reopen the database.
+    """
+    NER.set_memo(filename = os.path.join(tmpdir, 'nercache.db'))
+    ner = NER('ocr_allowlist')
+    memo = ner._get_memo()
+    assert len(memo) == 0
+    assert ner._get_memo() is memo
+    ner.detect_batch([])
+    assert ner._memo is memo
+    NER.set_memo(filename = None)
+
+def test_stanford_failure_not_memoised(tmpdir, monkeypatch):
+    """ If the Stanford classifier cannot run then nothing is detected,
+    and that is not remembered so it will be tried again.
+    """
+    monkeypatch.setenv('CORENLP_DATA_ROOT', str(tmpdir))
+    NER.set_memo(filename = os.path.join(tmpdir, 'nercache.db'))
+    ner = NER('stanford')
+    assert ner.isValid()
+    monkeypatch.setattr(stanford_ner.StanfordNERServer, 'command',
+        lambda self: [os.path.join(tmpdir, 'no_java')])
+    assert ner.detect('Queen Elizabeth Hospital') == []
+    assert ner.detect_batch(['Queen Elizabeth', 'Hospital']) == [[], []]
+    assert len(ner._get_memo()) == 0
+    NER.set_memo(filename = None)
+
+def test_data_signature(tmpdir):
+    assert data_signature(None) == ''
+    model = os.path.join(tmpdir, 'model.bin')
+    with open(model, 'w') as fd:
+        fd.write('weights')
+    sig_dir, sig_file = data_signature(str(tmpdir)), data_signature(model)
+    assert sig_dir and sig_file
+    with open(model, 'w') as fd:
+        fd.write('new weights')
+    assert data_signature(str(tmpdir)) != sig_dir
+    assert data_signature(model) != sig_file
+
+def test_ocr_allowlist_batch():
+    ner = NER('ocr_allowlist')
+    texts = ['PA ERECT', 'NOT ERECT', 'PA ERECT', '']
+    assert ner.detect_batch(texts) == [ner.detect(text) for text in texts]
+
 
 if __name__ == '__main__':
     persons = [
@@ -0,0 +1,266 @@
+""" The Pipeline class runs items through a sequence of stages, each
+stage having its own pool of threads, connected by bounded queues,
+so that e.g. reading files, OCR, NER and writing to a database can
+all happen at the same time on different files. It records the
+queue depth and utilisation of every stage for tuning the pool sizes.
+"""
+# Each Stage has a function which takes one item and returns one item
+# (or None to drop it), or if the stage has a batch size greater than 1
+# takes a list of items and returns a list. A batch is whatever is
+# waiting in the queue, up to the batch size, so a batch stage never
+# waits for a batch to fill. If a stage needs state which cannot be
+# shared between threads (e.g. a database connection) give it a factory
+# instead, which is called once in each of its threads to make its
+# function. Items leave the pipeline in no particular order when a
+# stage has more than one thread.
+# An exception from a stage function is logged and the item (or batch)
+# is dropped, so functions should handle their own expected errors.
+# If a factory raises an exception the thread still takes items from its
+# queue, so the pipeline does not stall, but drops them all as errors.
+# Each queue holds at most maxsize items, so a slow stage makes the
+# stages before it wait rather than filling memory. A stage can have a
+# smaller input queue of its own if its items are large.
+
+import logging
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Put into a queue to tell one thread of the stage to stop
+_STOP = object()
+
+
+class Stage:
+    """ One stage of a Pipeline, see the module description.
+    """
+    def __init__(self, name, func = None, threads = 1, batch = 1, factory = None, maxsize = None):
+        """ name is used in the stats, func(item) or func(list_of_items)
+        does the work, or factory() is called in each thread to return func.
+        threads is the number of threads, batch the maximum batch size,
+        maxsize the size of its input queue (default that of the Pipeline).
+        """
+        assert func or factory
+        self.name = name
+        self.func = func
+        self.factory = factory
+        self.threads = max(1, threads)
+        self.batch = max(1, batch)
+        self.maxsize = maxsize
+        self.queue = None
+        self._lock = threading.Lock()
+        self.items = 0
+        self.batches = 0
+        self.errors = 0
+        self.busy = 0.0        # seconds spent in func, summed over threads
+        self.blocked = 0.0     # seconds waiting for room in the next queue
+        self.max_depth = 0
+        self._depth_total = 0
+
+    def __repr__(self):
+        return '<Stage %s threads=%d batch=%d %d items>' % (self.name, self.threads, self.batch, self.items)
+
+    def _count(self, depth, items, busy, blocked, errors):
+        with self._lock:
+            self.batches += 1
+            self.items += items
+            self.busy += busy
+            self.blocked += blocked
+            self.errors += errors
+            self.max_depth = max(self.max_depth, depth)
+            self._depth_total += depth
+
+
+class Pipeline:
+    """ Run items through a list of Stages, see the module description.
+    """
+    def __init__(self, stages, maxsize = 8):
+        """ stages is a list of Stage objects, maxsize the number of
+        items each queue between stages can hold, unless the stage
+        has its own maxsize.
+        """
+        self.stages = stages
+        self.maxsize = maxsize
+        self.start_time = None
+        self.end_time = None
+
+    def __repr__(self):
+        return '<Pipeline %s>' % ' -> '.join(stage.name for stage in self.stages)
+
+    def _worker(self, idx):
+        """ Run by every thread of stages[idx] """
+        stage = self.stages[idx]
+        out = self.stages[idx+1].queue if idx+1 < len(self.stages) else None
+        try:
+            func = stage.factory() if stage.factory else stage.func
+        except Exception:
+            logger.exception('pipeline stage %s failed to start, dropping its items' % stage.name)
+            func = None
+        stopping = False
+        while not stopping:
+            depth = stage.queue.qsize()
+            item = stage.queue.get()
+            if item is _STOP:
+                break
+            batch = [item]
+            while len(batch) < stage.batch:
+                try:
+                    item = stage.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            start = time.perf_counter()
+            errors = 0
+            if func is None:
+                results, errors = [], len(batch)
+            else:
+                try:
+                    results = func(batch) if stage.batch > 1 else [func(batch[0])]
+                except Exception:
+                    logger.exception('pipeline stage %s failed' % stage.name)
+                    results, errors = [], len(batch)
+            busy = time.perf_counter() - start
+            for result in results:
+                if result is not None and out is not None:
+                    out.put(result)
+            stage._count(depth, len(batch), busy, time.perf_counter() - start - busy, errors)
+
+    def run(self, items, report_interval = None):
+        """ Put every item into the pipeline and wait for them all to
+        come out of the last stage. The items are read lazily as there
+        is room in the first queue. If report_interval is given then
+        report() is logged every report_interval seconds.
+        """
+        self.start_time, self.end_time = time.perf_counter(), None
+        threads = []
+        for idx, stage in enumerate(self.stages):
+            stage.queue = queue.Queue(stage.maxsize or self.maxsize)
+            threads.append([ threading.Thread(target = self._worker, args = (idx,),
+                name = '%s-%d' % (stage.name, num), daemon = True) for num in range(stage.threads) ])
+        for stage_threads in threads:
+            for thread in stage_threads:
+                thread.start()
+        finished = threading.Event()
+        if report_interval:
+            def reporter():
+                while not finished.wait(report_interval):
+                    logger.info(self.report())
+            threading.Thread(target = reporter, daemon = True).start()
+        try:
+            for item in items:
+                self.stages[0].queue.put(item)
+        finally:
+            # Stop each stage after the previous one has finished
+            for stage, stage_threads in zip(self.stages, threads):
+                for _ in stage_threads:
+                    stage.queue.put(_STOP)
+                for thread in stage_threads:
+                    thread.join()
+            finished.set()
+            self.end_time = time.perf_counter()
+
+    def stats(self):
+        """ Return a list of dicts, one per stage, with the number of
+        items, batches and errors, the seconds busy and blocked (waiting
+        for the next stage), the utilisation (fraction of the time its
+        threads were busy), and the current, maximum and mean depth of
+        its input queue (the mean is sampled each time it takes a batch).
+        Can be called while the pipeline is running.
+        """
+        if self.start_time is None:
+            return []
+        elapsed = max(1e-9, (self.end_time or time.perf_counter()) - self.start_time)
+        rc = []
+        for stage in self.stages:
+            with stage._lock:
+                rc.append({
+                    'stage': stage.name,
+                    'threads': stage.threads,
+                    'items': stage.items,
+                    'batches': stage.batches,
+                    'errors': stage.errors,
+                    'busy': stage.busy,
+                    'blocked': stage.blocked,
+                    'utilisation': stage.busy / (stage.threads * elapsed),
+                    'depth': stage.queue.qsize() if stage.queue else 0,
+                    'max_depth': stage.max_depth,
+                    'mean_depth': stage._depth_total / stage.batches if stage.batches else 0.0,
+                })
+        return rc
+
+    def report(self):
+        """ Return stats() as a table in a string """
+        lines = ['%-10s %7s %8s %8s %6s %9s %10s %6s %6s %6s' % ('stage', 'threads', 'items',
+            'batches', 'errors', 'busy(s)', 'blocked(s)', 'util', 'depth', 'max')]
+        for st in self.stats():
+            lines.append('%-10s %7d %8d %8d %6d %9.1f %10.1f %5.0f%% %6d %6d' % (st['stage'],
+                st['threads'], st['items'], st['batches'], st['errors'], st['busy'],
+                st['blocked'], 100 * st['utilisation'], st['depth'], st['max_depth']))
+        return '\n'.join(lines)
+
+
+# ---------------------------------------------------------------------
+
+def test_Pipeline():
+    seen = []
+    thread_ids = set()
+    def square(n):
+        time.sleep(0.001)
+        return None if n == 13 else n * n
+    def fail_on_49(n):
+        if n == 49:
+            raise ValueError('49')
+        return n
+    def make_collect():
+        thread_ids.add(threading.get_ident())
+        def collect(batch):
+            assert 1 <= len(batch) <= 10
+            seen.extend(batch)
+            return batch
+        return collect
+    pipe = Pipeline([ Stage('square', square, threads = 4),
+        Stage('check', fail_on_49, threads = 2, maxsize = 1),
+        Stage('collect', factory = make_collect, batch = 10) ], maxsize = 3)
+    pipe.run(range(100))
+    # 13 dropped by square, 49 by an exception
+    assert sorted(seen) == [ n*n for n in range(100) if n not in (7, 13) ]
+    assert len(thread_ids) == 1
+    stats = { st['stage']: st for st in pipe.stats() }
+    assert stats['square']['items'] == 100
+    assert stats['check']['items'] == 99
+    assert stats['check']['errors'] == 1
+    assert stats['collect']['items'] == 98
+    assert stats['collect']['batches'] <= 98
+    assert stats['square']['max_depth'] <= 3
+    assert stats['check']['max_depth'] <= 1
+    assert 0 < stats['square']['utilisation'] <= 1
+    assert 'square' in pipe.report()
+    # An empty input stops cleanly
+    pipe.run([])
+    # An exception reading the items still stops all the threads
+    def bad_items():
+        yield 1
+        raise RuntimeError('no more')
+    try:
+        pipe.run(bad_items())
+        assert False
+    except RuntimeError:
+        pass
+    assert threading.active_count() < 5
+    # A factory which fails drops every item instead of stalling the pipeline
+    def bad():
+        raise RuntimeError('no engine')
+    pipe = Pipeline([ Stage('a', square, threads = 2), Stage('b', factory = bad, batch = 4),
+        Stage('c', factory = make_collect) ], maxsize = 3)
+    seen.clear()
+    runner = threading.Thread(target = pipe.run, args = (range(20),), daemon = True)
+    runner.start()
+    runner.join(30)
+    assert not runner.is_alive()
+    stats = { st['stage']: st for st in pipe.stats() }
+    assert stats['b']['items'] == stats['b']['errors'] == 19
+    assert stats['c']['items'] == 0 and seen == []
@@ -7,11 +7,12 @@
   tests for PII.
 """
 
-from copy import deepcopy
-try:
-    from fastDamerauLevenshtein import damerauLevenshtein
-except:
-    damerauLevenshtein = False
+import struct
+import sys
+from array import array
+from bisect import bisect_left, insort
+from copy import copy
+from DicomPixelAnon.textsimilarity import text_similarity
 
 
 class Rect:
@@ -19,6 +20,9 @@ class Rect:
     Coordinates start at 0, top left.
     Negative coordinates represent a null/invalid rectangle.
     """
+    # No per-instance __dict__ because millions of these can be loaded
+    __slots__ = ('top', 'bottom', 'left', 'right')
+
     def __init__(self, top = -1, bottom = -1, left = -1, right = -1):
         self.top, self.bottom, self.left, self.right = top, bottom, left, right
 
@@ -129,6 +133,8 @@ class DicomRect(Rect):
     Overlay = -1 means frame is a standard frame.
     Overlay >= 0 means frame is within that overlay.
     """
+    __slots__ = ('frame', 'overlay')
+
     def __init__(self, top = None, bottom = None, left = None, right = None, frame = -1, overlay = -1, arect = None):
         if arect:
             super().__init__(arect.T(), arect.B(), arect.L(), arect.R())
@@ -184,6 +190,7 @@ class DicomRectText(DicomRect):
     Right now ocrengine (enum), ocrtext (str), nerengine (enum), nerpii (enum)
     are all considered together so returned as a tuple from text_tuple().
     """
+    __slots__ = ('ocrengine', 'ocrtext', 'nerengine', 'nerpii')
     pii_not_checked = -1
     pii_not_found = 0
     pii_possible = 1
@@ -219,15 +226,10 @@ class DicomRectText(DicomRect):
         """
         if not super().similar(other_rect):
             return False
-        sim_lim = 0.9 # text must be very similar to be same rectangle
+        # text must be very similar to be same rectangle, see TextSimilarity
         _, txt, _, _ = self.text_tuple()
         _, TXT, _, _ = other_rect.text_tuple()
-        if damerauLevenshtein == False:
-            return txt == TXT
-        txt_sim = damerauLevenshtein(txt, TXT, similarity=True)
-        if txt_sim < sim_lim:
-            return False
-        return True
+        return text_similarity.similar(txt, TXT)
 
 
 # ---------------------------------------------------------------------
@@ -255,6 +257,141 @@ def test_similar():
     assert r4.get_rect() == (10,22,30,44)
 
 
+# ---------------------------------------------------------------------
+
+class PackedRects:
+    """ A compact container for a large number of DicomRectText,
+    storing ten 32-bit integers per rectangle (top, bottom, left, right,
+    frame, overlay, ocrengine, nerengine, nerpii, text index) in an array
+    plus a table of unique text strings, so each rectangle costs about
+    40 bytes instead of a Python object. Indexing or iterating returns
+    new DicomRectText objects. to_bytes() and from_bytes() convert to
+    and from a binary format for writing to disk or sending between
+    processes (the object can also be pickled).
+    """
+    magic = b'DRT1'
+    _header = struct.Struct('<4sII') # magic, number of rects, number of texts
+    _length = struct.Struct('<I')
+
+    def __init__(self, rects = None):
+        self._ints = array('i')
+        self._texts = []
+        self._text_index = {}
+        if rects:
+            self.extend(rects)
+
+    def __len__(self):
+        return len(self._ints) // 10
+
+    def __repr__(self):
+        return '<PackedRects %d rects, %d texts>' % (len(self), len(self._texts))
+
+    def __getstate__(self):
+        return (self._ints, self._texts)
+
+    def __setstate__(self, state):
+        self._ints, self._texts = state
+        self._text_index = { text: idx for idx, text in enumerate(self._texts) }
+
+    def append(self, rect):
+        """ Add a Rect, DicomRect or DicomRectText (missing values
+        take the DicomRectText defaults).
+        """
+        t, b, l, r = rect.get_rect()
+        frame = rect.F() if isinstance(rect, DicomRect) else -1
+        overlay = rect.O() if isinstance(rect, DicomRect) else -1
+        if isinstance(rect, DicomRectText):
+            ocrengine, ocrtext, nerengine, nerpii = rect.text_tuple()
+        else:
+            ocrengine, ocrtext, nerengine, nerpii = -1, '', 0, -1
+        text_idx = self._text_index.get(ocrtext)
+        if text_idx is None:
+            text_idx = self._text_index[ocrtext] = len(self._texts)
+            self._texts.append(ocrtext)
+        self._ints.extend((t, b, l, r, frame, overlay, ocrengine, nerengine, nerpii, text_idx))
+
+    def extend(self, rects):
+        for rect in rects:
+            self.append(rect)
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+        if idx < 0 or idx >= len(self):
+            raise IndexError('PackedRects index out of range')
+        t, b, l, r, frame, overlay, ocrengine, nerengine, nerpii, text_idx = self._ints[idx*10 : idx*10+10]
+        return DicomRectText(t, b, l, r, frame, overlay, ocrengine, self._texts[text_idx], nerengine, nerpii)
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def to_bytes(self):
+        """ Return the binary encoding: a header, the integers in
+        little-endian order, then each text as a length and UTF-8.
+        """
+        ints = array('i', self._ints)
+        if sys.byteorder != 'little':
+            ints.byteswap()
+        parts = [ PackedRects._header.pack(PackedRects.magic, len(self), len(self._texts)), ints.tobytes() ]
+        for text in self._texts:
+            encoded = text.encode('utf-8')
+            parts.append(PackedRects._length.pack(len(encoded)))
+            parts.append(encoded)
+        return b''.join(parts)
+
+    @staticmethod
+    def from_bytes(data):
+        """ Return a new PackedRects from the output of to_bytes()
+        """
+        magic, nrects, ntexts = PackedRects._header.unpack_from(data, 0)
+        if magic != PackedRects.magic:
+            raise ValueError('not a packed rectangle encoding')
+        offset = PackedRects._header.size
+        rc = PackedRects()
+        rc._ints.frombytes(data[offset : offset + nrects * 40])
+        if sys.byteorder != 'little':
+            rc._ints.byteswap()
+        offset += nrects * 40
+        for _ in range(ntexts):
+            (length,) = PackedRects._length.unpack_from(data, offset)
+            offset += PackedRects._length.size
+            rc._texts.append(bytes(data[offset : offset + length]).decode('utf-8'))
+            offset += length
+        rc._text_index = { text: idx for idx, text in enumerate(rc._texts) }
+        return rc
+
+
+def test_PackedRects():
+    import pickle
+    import tracemalloc
+    rects = [ Rect(1, 11, 2, 12), DicomRect(3, 33, 4, 44, 9, 10),
+        DicomRectText(10, 20, 30, 40, 2, 3, 1, 'jane', 50, 1),
+        DicomRectText(10, 20, 300, 400, 2, 3, 1, 'jane', 50, 1),
+        DicomRectText(10, 20, 30, 40, 2, 3, 1, 'caf\u00e9', 50, 0) ]
+    packed = PackedRects(rects)
+    assert len(packed) == 5
+    assert repr(packed) == '<PackedRects 5 rects, 3 texts>'
+    assert str(packed[0]) == '<DicomRectText frame=-1 overlay=-1 2,1->12,11 -1="" 0=-1>'
+    assert str(packed[-1]) == str(rects[-1])
+    for copied in [ PackedRects.from_bytes(packed.to_bytes()), pickle.loads(pickle.dumps(packed)) ]:
+        assert [str(r) for r in copied] == [str(r) for r in packed]
+    # The rect classes have no __dict__
+    assert not hasattr(rects[2], '__dict__')
+    # Memory per rect is much less than the objects themselves
+    n = 10000
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    objs = [DicomRectText(i, i+10, i, i+20, 0, -1, 1, 'AP ERECT', 2, 0) for i in range(n)]
+    obj_mem = tracemalloc.get_traced_memory()[0] - before
+    packed = PackedRects(objs)
+    del objs
+    packed_mem = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    assert packed_mem * 3 < obj_mem
+    assert len(packed.to_bytes()) < 41 * n + 100
+
+
 # ---------------------------------------------------------------------
 
 def rect_is_huge_font(rect):
@@ -341,6 +478,161 @@ def test_add_Rect_to_list():
         '[<DicomRectText frame=1 overlay=2 28,8->42,20 -1="jane macleod" 0=-1>, <DicomRectText frame=1 overlay=2 300,100->400,200 -1="jane macleod" 0=-1>]')
 
 
+# ---------------------------------------------------------------------
+
+class RectGrid:
+    """ Holds a list of rectangles built up by add_Rect_to_list semantics
+    but with a uniform grid spatial index so that finding the rects which
+    contain, are contained by, or are similar to a new rect does not need
+    to scan the whole list. Use this instead of add_Rect_to_list when
+    adding many rectangles. The result of rects() is identical to calling
+    add_Rect_to_list for every rectangle in the same order.
+    """
+    # Width and height of a grid cell in pixels
+    cell_size = 64
+
+    def __init__(self, cell_size = None, first_seq = 0):
+        """ first_seq is the seq given to the first rect added, see items().
+        """
+        self.cell_size = cell_size if cell_size else RectGrid.cell_size
+        self._rects = {}    # seq -> rect, seq gives the list order
+        self._cells = {}    # (x,y) cell -> set of seq
+        self._seq = first_seq
+
+    def __len__(self):
+        return len(self._rects)
+
+    def __repr__(self):
+        return '<RectGrid %d rects in %d cells>' % (len(self._rects), len(self._cells))
+
+    def rects(self):
+        """ Return the list of rectangles in list order """
+        return [self._rects[seq] for seq in sorted(self._rects)]
+
+    def items(self):
+        """ Return a list of (seq, rect) in list order, seq being the
+        position of the rect in the order they were added.
+        """
+        return sorted(self._rects.items())
+
+    def load(self, seq, rect):
+        """ Put back a rect returned by items() without checking it against
+        the others, so part of a list can be restored and added to.
+        """
+        self._insert(seq, rect)
+        self._seq = max(self._seq, seq + 1)
+
+    def _cell_range(self, t, b, l, r):
+        cs = self.cell_size
+        return [(x, y) for x in range(l // cs, r // cs + 1) for y in range(t // cs, b // cs + 1)]
+
+    def _insert(self, seq, rect):
+        self._rects[seq] = rect
+        for cell in self._cell_range(*rect.get_rect()):
+            self._cells.setdefault(cell, set()).add(seq)
+
+    def _remove(self, seq):
+        rect = self._rects.pop(seq)
+        for cell in self._cell_range(*rect.get_rect()):
+            self._cells[cell].discard(seq)
+            if not self._cells[cell]:
+                del self._cells[cell]
+
+    def _query(self, t, b, l, r):
+        """ Return a sorted list of seq of rects which may overlap the area """
+        found = set()
+        for cell in self._cell_range(t, b, l, r):
+            found |= self._cells.get(cell, set())
+        return sorted(found)
+
+    def add(self, addrect, coalesce_similar = False):
+        """ Add a rectangle, see add_Rect_to_list for the semantics.
+        """
+        if not addrect.is_valid():
+            return
+        t, b, l, r = addrect.get_rect()
+        # Remove all the rects which are inside the new one
+        for seq in self._query(t, b, l, r):
+            if addrect.contains_rect(self._rects[seq]):
+                self._remove(seq)
+        # Ignore if an existing one contains the top-left corner and the whole rect
+        for seq in self._query(t, t, l, l):
+            if self._rects[seq].contains_rect(addrect):
+                return
+        # Modify the first existing one (in list order) if similar
+        if coalesce_similar:
+            lim = 4 # same as Rect.similar
+            candidates = []
+            for seq in self._query(t - lim, t + lim, l - lim, l + lim):
+                rect = self._rects[seq]
+                if isinstance(rect, DicomRectText) and isinstance(addrect, DicomRectText):
+                    # Check the geometry now and the texts all together below
+                    if DicomRect.similar(rect, addrect):
+                        candidates.append((seq, True))
+                elif rect.similar(addrect):
+                    candidates.append((seq, False))
+            texts = [self._rects[seq].ocrtext for seq, check_text in candidates if check_text]
+            text_ok = iter(text_similarity.similar_many(addrect.ocrtext, texts) if texts else [])
+            for seq, check_text in candidates:
+                if check_text and not next(text_ok):
+                    continue
+                rect = self._rects[seq]
+                self._remove(seq)
+                rect.make_mbr(addrect)
+                self._insert(seq, rect)
+                return
+        self._insert(self._seq, addrect)
+        self._seq += 1
+
+
+def test_RectGrid():
+    import random
+    rng = random.Random(42)
+    texts = ['jane', 'jane', 'doe', '']
+    rects = []
+    for _ in range(600):
+        t = rng.randint(0, 300)
+        l = rng.randint(0, 300)
+        h = rng.choice([2, 8, 20, 80, 200])
+        w = rng.choice([2, 8, 20, 80, 200])
+        rects.append((t, t + h, l, l + w, rng.randint(0, 1), rng.choice(texts)))
+    def check(coalesce, cell_size):
+        expected = []
+        grid = RectGrid(cell_size)
+        for t, b, l, r, frame, text in rects:
+            add_Rect_to_list(expected, DicomRectText(t, b, l, r, frame, -1, -1, text), coalesce)
+            grid.add(DicomRectText(t, b, l, r, frame, -1, -1, text), coalesce)
+        assert str(grid.rects()) == str(expected)
+    for coalesce in [False, True]:
+        for cell_size in [16, 64, 1000]:
+            check(coalesce, cell_size)
+    # Also with an edit distance so texts can be similar without being equal
+    from DicomPixelAnon.textsimilarity import osa_similarity
+    saved = text_similarity.similarity_func
+    try:
+        text_similarity.similarity_func = osa_similarity
+        text_similarity._cache.clear()
+        texts[:] = ['jane maclean', 'jane maclan', 'jane macla', 'doe']
+        rects = [(t, b, l, r, frame, rng.choice(texts)) for t, b, l, r, frame, _ in rects]
+        check(True, 64)
+    finally:
+        text_similarity.similarity_func = saved
+        text_similarity._cache.clear()
+    grid = RectGrid()
+    grid.add(Rect(-1, -1, -1, -1))
+    grid.add(Rect(10, 20, 10, 20))
+    grid.add(Rect(12, 18, 12, 18))
+    grid.add(Rect(0, 100, 0, 100))
+    assert grid.rects() == [Rect(0, 100, 0, 100)]
+    # Restoring part of a list and adding to it
+    grid = RectGrid(first_seq = 10)
+    grid.load(3, Rect(0, 10, 0, 10))
+    grid.load(7, Rect(50, 60, 50, 60))
+    grid.add(Rect(52, 61, 51, 60), coalesce_similar = True)
+    grid.add(Rect(100, 110, 100, 110))
+    assert grid.items() == [(3, Rect(0, 10, 0, 10)), (7, Rect(50, 61, 50, 60)), (10, Rect(100, 110, 100, 110))]
+
+
 # ---------------------------------------------------------------------
 
 def rect_exclusive_list(rectlist, width, height):
@@ -348,38 +640,87 @@ def rect_exclusive_list(rectlist, width, height):
     that is not covered by any rectangle in rectlist, so the equivalent of
     filling all the rectangles in rectlist and then negating that.
     NOTE: if rectlist is empty then return an empty list, not a full frame.
-    XXX need to take frame,overlay arguments and pass to DicomRect constructor.
+    Coordinates are inclusive, as everywhere else, so the result does not
+    overlap any of the given rectangles nor each other.
+    The returned rectangles are copies of the first one in rectlist,
+    so frame, overlay and ocrengine are preserved, and they are sorted
+    by top then left.
+    The image is swept from top to bottom in bands where the set of
+    rectangles does not change; within each band the uncovered runs of
+    columns are found and runs which continue unchanged from the band
+    above are merged into a single taller rectangle.
+    The spans of the rectangles crossing the band are kept sorted as
+    rectangles start and end, so each band costs a scan of those spans,
+    O(n) for n rectangles, and the whole sweep is O(n^2) in the worst
+    case (every rectangle crossing every band) but nearer O(n) when the
+    rectangles are small and scattered, as OCR text usually is.
+    The result is not the fewest possible rectangles: a run is only
+    merged downwards when it has exactly the same columns, so an area
+    beside a rectangle is split into pieces above, beside and below it.
     """
     # If not given anything to negate then return empty, not full frame rect.
     if not rectlist:
         return []
-    # Start with a rectangle which is full size
-    r0 = deepcopy(rectlist[0]).set_rect(0, height-1, 0, width-1)
-    newlist = [ r0 ]
-    for inner_rect in rectlist:
-        new2list = []
-        for newrect in newlist:
-            intersection = newrect.intersect_rect(inner_rect)
-            if intersection.is_valid():
-                # Replace newrect with four surrounding rect
-                nl,nt,nr,nb = newrect.ltrb()
-                l,t,r,b = intersection.ltrb()
-                # Create a new object of same type as original, and preserve ocrengine value
-                # Set coordinates in the order: (T,B,L,R)
-                # XXX these are off-by-one and need fixed
-                r1 = deepcopy(rectlist[0]).set_rect(min(t,nt), t, min(l,nl), max(r,nr))
-                r2 = deepcopy(rectlist[0]).set_rect(t, b, min(l,nl), l)
-                r3 = deepcopy(rectlist[0]).set_rect(t, b, r, max(r,nr))
-                r4 = deepcopy(rectlist[0]).set_rect(b, max(b,nb), min(l,nl), max(r,nr))
-                add_Rect_to_list(new2list, r1)
-                add_Rect_to_list(new2list, r2)
-                add_Rect_to_list(new2list, r3)
-                add_Rect_to_list(new2list, r4)
-            else:
-                add_Rect_to_list(new2list, newrect)
-        newlist = new2list
-    # XXX should really coalesce all adjoining rectangles for efficiency
-    return newlist
+    # Clip to the image and index the spans by the row they start and end
+    starts, ends = {}, {}
+    for rect in rectlist:
+        t, b, l, r = rect.get_rect()
+        t, b, l, r = max(t, 0), min(b, height-1), max(l, 0), min(r, width-1)
+        if t > b or l > r:
+            continue
+        starts.setdefault(t, []).append((l, r))
+        ends.setdefault(b+1, []).append((l, r))
+    rows = sorted(set([0, height]) | set(starts) | set(ends))
+    active = []     # sorted (l,r) of the rects in this band, with repeats
+    open_rects = {} # (l,r) of an uncovered run -> top row where it began
+    found = []      # (t,b,l,r)
+    for y0, y1 in zip(rows, rows[1:]):
+        for span in ends.get(y0, []):
+            del active[bisect_left(active, span)]
+        for span in starts.get(y0, []):
+            insort(active, span)
+        # Find the columns not covered by any active span
+        runs = []
+        x = 0
+        for l, r in active:
+            if l > x:
+                runs.append((x, l-1))
+            x = max(x, r+1)
+        if x < width:
+            runs.append((x, width-1))
+        # Continue the runs from the band above, close those which ended
+        new_open = { run: open_rects.get(run, y0) for run in runs }
+        for run, top in open_rects.items():
+            if run not in new_open:
+                found.append((top, y0-1, run[0], run[1]))
+        open_rects = new_open
+    for run, top in open_rects.items():
+        found.append((top, height-1, run[0], run[1]))
+    return [ copy(rectlist[0]).set_rect(t, b, l, r) for t, b, l, r in sorted(found, key = lambda f: (f[0], f[2])) ]
+
+
+def test_rect_exclusive_list():
+    # Overlapping and adjoining rectangles
+    rl = rect_exclusive_list([Rect(2, 5, 2, 5), Rect(4, 7, 4, 7), Rect(2, 7, 8, 9)], 10, 10)
+    assert rl == [Rect(0, 1, 0, 9), Rect(2, 5, 0, 1), Rect(2, 3, 6, 7),
+        Rect(6, 7, 0, 3), Rect(8, 9, 0, 9)]
+    # Every pixel is covered exactly once by either the input or the output
+    import random
+    rng = random.Random(1)
+    for _ in range(20):
+        keep = []
+        for _ in range(rng.randint(1, 8)):
+            t, l = rng.randint(-5, 40), rng.randint(-5, 40)
+            keep.append(DicomRect(t, t+rng.randint(0, 20), l, l+rng.randint(0, 20), 3, 4))
+        out = rect_exclusive_list(keep, 37, 31)
+        assert all(r.F() == 3 and r.O() == 4 for r in out)
+        for y in range(31):
+            for x in range(37):
+                kept = any(r.contains(x, y) for r in keep)
+                assert sum(r.contains(x, y) for r in out) == (0 if kept else 1)
+    # Null rectangles are ignored, and nothing to negate gives nothing
+    assert rect_exclusive_list([Rect()], 4, 3) == [Rect(0, 2, 0, 3)]
+    assert rect_exclusive_list([], 4, 3) == []
 
 
 # ---------------------------------------------------------------------
@@ -436,13 +777,13 @@ def test_rect():
     add_Rect_to_list(list3, r4)
     r_e_list = rect_exclusive_list(list3, 1024, 1024)
     expected = [
-        Rect(left=0,top=0, right=1023,bottom=37),
-        Rect(left=0,top=37, right=238,bottom=348),
-        Rect(left=786,top=37, right=1023,bottom=348),
-        Rect(left=0,top=348, right=1023,bottom=452),
-        Rect(left=0,top=452, right=42,bottom=732),
-        Rect(left=943,top=452, right=1023,bottom=732),
-        Rect(left=0,top=732, right=1023,bottom=1023)
+        Rect(left=0,top=0, right=1023,bottom=36),
+        Rect(left=0,top=37, right=237,bottom=348),
+        Rect(left=787,top=37, right=1023,bottom=348),
+        Rect(left=0,top=349, right=1023,bottom=451),
+        Rect(left=0,top=452, right=41,bottom=732),
+        Rect(left=944,top=452, right=1023,bottom=732),
+        Rect(left=0,top=733, right=1023,bottom=1023)
         ]
     assert(r_e_list == expected)
     # Plot for visual verification
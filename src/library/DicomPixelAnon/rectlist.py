@@ -0,0 +1,348 @@
+""" The RectList class holds many rectangles in NumPy arrays,
+one element per rectangle, so that geometric operations can be
+performed on all of them at once rather than one Python object at a time.
+It can be converted to and from lists of Rect, DicomRect, DicomRectText.
+"""
+# The columns are the same as the attributes of DicomRectText:
+#   top, bottom, left, right, frame, overlay (int32)
+#   ocrengine, nerengine, nerpii (int32), ocrtext (Python str)
+# Coordinates have the same meaning as in rect.py, inclusive, with
+# -1 meaning a null rectangle, and frame,overlay -1 meaning not applicable.
+
+import numpy as np
+from DicomPixelAnon.rect import Rect, DicomRect, DicomRectText
+
+
+class RectList:
+    """ Holds a list of rectangles in a NumPy structured array.
+    """
+    dtype = np.dtype([
+        ('top', np.int32), ('bottom', np.int32),
+        ('left', np.int32), ('right', np.int32),
+        ('frame', np.int32), ('overlay', np.int32),
+        ('ocrengine', np.int32), ('nerengine', np.int32), ('nerpii', np.int32),
+        ('ocrtext', object)])
+    # Coordinates must be within this many pixels to be similar, see Rect.similar
+    similar_limit = 4
+    # Masks for more rects than this are built using a summed-area table
+    mask_summed_area_threshold = 16
+
+    def __init__(self, array = None):
+        """ Construct from a structured array of RectList.dtype,
+        or an empty list if not given.
+        """
+        if array is None:
+            array = np.zeros(0, dtype = RectList.dtype)
+        self.array = array
+
+    @staticmethod
+    def from_rects(rects):
+        """ Return a RectList from a list of Rect, DicomRect or DicomRectText.
+        Missing values are filled in with the DicomRectText defaults.
+        """
+        array = np.zeros(len(rects), dtype = RectList.dtype)
+        rows = []
+        for rect in rects:
+            t, b, l, r = rect.get_rect()
+            frame = rect.F() if hasattr(rect, 'F') else -1
+            overlay = rect.O() if hasattr(rect, 'O') else -1
+            if hasattr(rect, 'text_tuple'):
+                ocrengine, ocrtext, nerengine, nerpii = rect.text_tuple()
+            else:
+                ocrengine, ocrtext, nerengine, nerpii = -1, '', 0, -1
+            rows.append((t, b, l, r, frame, overlay, ocrengine, nerengine, nerpii, ocrtext))
+        if rows:
+            array[:] = rows
+        return RectList(array)
+
+    @staticmethod
+    def from_arrays(top, bottom, left, right, frame = -1, overlay = -1,
+            ocrengine = -1, ocrtext = '', nerengine = 0, nerpii = -1):
+        """ Return a RectList from arrays (or scalars) of each column.
+        """
+        n = len(np.atleast_1d(top))
+        array = np.zeros(n, dtype = RectList.dtype)
+        for name, value in [('top', top), ('bottom', bottom), ('left', left), ('right', right),
+                ('frame', frame), ('overlay', overlay),
+                ('ocrengine', ocrengine), ('nerengine', nerengine), ('nerpii', nerpii)]:
+            array[name] = value
+        if isinstance(ocrtext, str):
+            array['ocrtext'] = [ocrtext] * n
+        else:
+            array['ocrtext'] = list(ocrtext)
+        return RectList(array)
+
+    @staticmethod
+    def concatenate(rectlists):
+        """ Return a new RectList holding all the given RectLists.
+        """
+        return RectList(np.concatenate([rl.array for rl in rectlists] or
+            [np.zeros(0, dtype = RectList.dtype)]))
+
+    def to_rects(self, cls = DicomRectText):
+        """ Return a list of objects of the given class
+        which can be Rect, DicomRect or DicomRectText.
+        """
+        rc = []
+        for row in self.array.tolist():
+            t, b, l, r, frame, overlay, ocrengine, nerengine, nerpii, ocrtext = row
+            if cls is Rect:
+                rc.append(Rect(t, b, l, r))
+            elif cls is DicomRect:
+                rc.append(DicomRect(t, b, l, r, frame, overlay))
+            else:
+                rc.append(DicomRectText(t, b, l, r, frame, overlay,
+                    ocrengine, ocrtext, nerengine, nerpii))
+        return rc
+
+    def __len__(self):
+        return len(self.array)
+
+    def __getitem__(self, idx):
+        """ An integer index returns a DicomRectText,
+        a slice, index array or boolean mask returns a RectList.
+        """
+        if isinstance(idx, (int, np.integer)):
+            return RectList(self.array[idx:idx+1] if idx != -1 else self.array[idx:]).to_rects()[0]
+        return RectList(self.array[idx])
+
+    def __iter__(self):
+        return iter(self.to_rects())
+
+    def __repr__(self):
+        return '<RectList %d rects>' % len(self.array)
+
+    def __eq__(self, other):
+        return (isinstance(other, RectList) and len(self) == len(other) and
+            all(self.array[name].tolist() == other.array[name].tolist() for name in RectList.dtype.names))
+
+    # Column accessors, as arrays
+    def T(self):
+        return self.array['top']
+
+    def B(self):
+        return self.array['bottom']
+
+    def L(self):
+        return self.array['left']
+
+    def R(self):
+        return self.array['right']
+
+    def F(self):
+        return self.array['frame']
+
+    def O(self):
+        return self.array['overlay']
+
+    def ltrb(self):
+        """ Return an array of shape (n,4) with left, top, right, bottom """
+        return np.stack([self.L(), self.T(), self.R(), self.B()], axis = -1)
+
+    def ltwh(self):
+        """ Return an array of shape (n,4) with left, top, width, height """
+        return np.stack([self.L(), self.T(), 1 + self.R() - self.L(), 1 + self.B() - self.T()], axis = -1)
+
+    def is_valid(self):
+        """ Return a boolean array, True where the rect coordinates make sense """
+        t, b, l, r = self.T(), self.B(), self.L(), self.R()
+        return (t >= 0) & (b > t) & (l >= 0) & (r > l)
+
+    def contains_rect(self, rect):
+        """ Return a boolean array, True where the rect in this list
+        fully contains (or equals) the given rect, like Rect.contains_rect.
+        Frame and overlay are not checked.
+        """
+        t, b, l, r = rect.get_rect()
+        return (self.L() <= l) & (l <= self.R()) & (self.T() <= t) & (t <= self.B()) & \
+            (self.L() <= r) & (r <= self.R()) & (self.T() <= b) & (b <= self.B())
+
+    def contained_in_rect(self, rect):
+        """ Return a boolean array, True where the rect in this list
+        is fully inside (or equal to) the given rect.
+        Frame and overlay are not checked.
+        """
+        t, b, l, r = rect.get_rect()
+        T, B, L, R = self.T(), self.B(), self.L(), self.R()
+        return (l <= L) & (L <= r) & (t <= T) & (T <= b) & \
+            (l <= R) & (R <= r) & (t <= B) & (B <= b)
+
+    def contains_matrix(self, other = None):
+        """ Return a boolean array of shape (len(self), len(other)) which is
+        True where self[i] contains other[j]. Frame and overlay are not checked.
+        """
+        other = self if other is None else other
+        T, B, L, R = [c[:, np.newaxis] for c in (self.T(), self.B(), self.L(), self.R())]
+        t, b, l, r = [c[np.newaxis, :] for c in (other.T(), other.B(), other.L(), other.R())]
+        return (L <= l) & (l <= R) & (T <= t) & (t <= B) & \
+            (L <= r) & (r <= R) & (T <= b) & (b <= B)
+
+    def intersect_rect(self, rect):
+        """ Return a RectList of the intersection of each rect with the given rect,
+        like Rect.intersect_rect, with null (-1) rects where there is no intersection.
+        Other columns are copied from this list.
+        """
+        t, b, l, r = rect.get_rect()
+        array = self.array.copy()
+        array['left'] = np.maximum(self.L(), l)
+        array['right'] = np.minimum(self.R(), r)
+        array['top'] = np.maximum(self.T(), t)
+        array['bottom'] = np.minimum(self.B(), b)
+        null = (array['left'] >= array['right']) | (array['top'] >= array['bottom'])
+        for name in ['top', 'bottom', 'left', 'right']:
+            array[name][null] = -1
+        return RectList(array)
+
+    def similar_rect(self, rect, check_frame_overlay = True):
+        """ Return a boolean array, True where the rect in this list has
+        coordinates within a few pixels of the given rect, like DicomRect.similar.
+        If check_frame_overlay then the frame and overlay must also match.
+        The text is not compared.
+        """
+        t, b, l, r = rect.get_rect()
+        lim = RectList.similar_limit
+        rc = ((np.abs(self.T() - t) <= lim) & (np.abs(self.B() - b) <= lim) &
+            (np.abs(self.L() - l) <= lim) & (np.abs(self.R() - r) <= lim))
+        if check_frame_overlay:
+            rc &= (self.F() == (rect.F() if hasattr(rect, 'F') else -1))
+            rc &= (self.O() == (rect.O() if hasattr(rect, 'O') else -1))
+        return rc
+
+    def similar_matrix(self, other = None, check_frame_overlay = True):
+        """ Return a boolean array of shape (len(self), len(other)) which is
+        True where self[i] is similar to other[j], see similar_rect.
+        """
+        other = self if other is None else other
+        lim = RectList.similar_limit
+        rc = np.ones((len(self), len(other)), dtype = bool)
+        names = ['top', 'bottom', 'left', 'right']
+        for name in names:
+            rc &= np.abs(self.array[name][:, np.newaxis].astype(np.int64) - other.array[name][np.newaxis, :]) <= lim
+        if check_frame_overlay:
+            for name in ['frame', 'overlay']:
+                rc &= self.array[name][:, np.newaxis] == other.array[name][np.newaxis, :]
+        return rc
+
+    def mbr(self, labels = None):
+        """ Return a RectList of Minimum Bounding Rectangles.
+        If labels is None then a single MBR of all rects is returned,
+        otherwise labels is an integer array (one per rect) and one MBR
+        is returned per distinct label, in ascending label order, with the
+        other columns taken from the first rect having that label
+        (except ocrtext which is the longest text, as in coalescing).
+        """
+        if labels is None:
+            labels = np.zeros(len(self), dtype = np.int64)
+        uniq, first, inverse = np.unique(labels, return_index = True, return_inverse = True)
+        array = self.array[first].copy()
+        for name, func, init in [('top', np.minimum, np.iinfo(np.int32).max),
+                ('bottom', np.maximum, np.iinfo(np.int32).min),
+                ('left', np.minimum, np.iinfo(np.int32).max),
+                ('right', np.maximum, np.iinfo(np.int32).min)]:
+            col = np.full(len(uniq), init, dtype = np.int32)
+            func.at(col, inverse, self.array[name])
+            array[name] = col
+        for idx, text in zip(inverse.tolist(), self.array['ocrtext'].tolist()):
+            if len(text) > len(array['ocrtext'][idx]):
+                array['ocrtext'][idx] = text
+        return RectList(array)
+
+    def mask(self, height, width, packed = False):
+        """ Return a boolean array (height, width) which is True for
+        every pixel inside any of the rects (coordinates are inclusive).
+        Rects are clipped to the image, frame and overlay are ignored.
+        If packed then the mask is bit-packed along each row (np.packbits).
+        For many rects the corners are marked +1/-1 in a difference array
+        and a summed-area (cumulative sum) gives the coverage, so the cost
+        does not depend on how large or overlapping the rects are.
+        """
+        t = np.clip(self.T().astype(np.int64), 0, height)
+        b = np.clip(self.B().astype(np.int64) + 1, 0, height)
+        l = np.clip(self.L().astype(np.int64), 0, width)
+        r = np.clip(self.R().astype(np.int64) + 1, 0, width)
+        keep = (self.T() >= 0) & (self.L() >= 0) & (t < b) & (l < r)
+        t, b, l, r = t[keep], b[keep], l[keep], r[keep]
+        if len(t) <= RectList.mask_summed_area_threshold:
+            mask = np.zeros((height, width), dtype = bool)
+            for y0, y1, x0, x1 in zip(t.tolist(), b.tolist(), l.tolist(), r.tolist()):
+                mask[y0:y1, x0:x1] = True
+        else:
+            diff = np.zeros((height + 1, width + 1), dtype = np.int32)
+            np.add.at(diff, (t, l), 1)
+            np.add.at(diff, (t, r), -1)
+            np.add.at(diff, (b, l), -1)
+            np.add.at(diff, (b, r), 1)
+            mask = diff.cumsum(axis = 0).cumsum(axis = 1)[:height, :width] > 0
+        if packed:
+            return np.packbits(mask, axis = -1)
+        return mask
+
+    def frame_overlay_groups(self):
+        """ Return a dict mapping (frame, overlay) to a RectList
+        of the rects having that frame and overlay.
+        """
+        rc = {}
+        if not len(self):
+            return rc
+        keys = np.stack([self.F(), self.O()], axis = -1)
+        uniq, inverse = np.unique(keys, axis = 0, return_inverse = True)
+        inverse = inverse.reshape(-1)
+        for idx, (frame, overlay) in enumerate(uniq.tolist()):
+            rc[(frame, overlay)] = RectList(self.array[inverse == idx])
+        return rc
+
+
+# ---------------------------------------------------------------------
+
+def test_RectList_conversion():
+    rects = [Rect(1, 11, 2, 12), DicomRect(3, 33, 4, 44, 9, 10),
+        DicomRectText(10, 20, 30, 40, 2, 3, 1, 'jane', 50, 1)]
+    rl = RectList.from_rects(rects)
+    assert len(rl) == 3
+    back = rl.to_rects()
+    assert str(back[0]) == '<DicomRectText frame=-1 overlay=-1 2,1->12,11 -1="" 0=-1>'
+    assert rl.to_rects(DicomRect)[1] == rects[1]
+    assert back[2] == rects[2] and back[2].text_tuple() == (1, 'jane', 50, 1)
+    assert str(rl[-1]) == str(rects[2])
+    assert rl.to_rects(DicomRect)[1] == rects[1]
+    assert rl[rl.F() == 9].to_rects(DicomRect) == [rects[1]]
+    assert RectList.from_rects([]).to_rects() == []
+    assert RectList.concatenate([rl, rl[:1]]).to_rects(Rect)[3] == Rect(1, 11, 2, 12)
+    arr = RectList.from_arrays([1, 2], [3, 4], [5, 6], [7, 8], frame = 0)
+    assert arr.to_rects(DicomRect) == [DicomRect(1, 3, 5, 7, 0), DicomRect(2, 4, 6, 8, 0)]
+
+
+def test_RectList_geometry():
+    rects = [Rect(1, 11, 2, 12), DicomRect(3, 33, 4, 44, 9, 10), DicomRect(4, 30, 5, 40),
+        Rect(10, 30, 10, 40), Rect(20, 40, 15, 20), Rect(-1, -1, -1, -1)]
+    rl = RectList.from_rects(rects)
+    # Same answers as the scalar methods
+    for other in rects:
+        assert rl.contains_rect(other).tolist() == [r.contains_rect(other) for r in rects]
+        assert rl.contained_in_rect(other).tolist() == [other.contains_rect(r) for r in rects]
+        assert rl.intersect_rect(other).to_rects(Rect) == [r.intersect_rect(other) for r in rects]
+    assert rl.contains_matrix().tolist() == [[r.contains_rect(o) for o in rects] for r in rects]
+    assert rl.is_valid().tolist() == [r.is_valid() for r in rects]
+    assert rl.ltwh()[0].tolist() == list(rects[0].ltwh())
+    # Similar
+    sl = RectList.from_rects([DicomRect(10,20,30,40,2,3), DicomRect(11,21,31,41,2,3), DicomRect(12,22,33,44,2,4)])
+    assert sl.similar_rect(DicomRect(10,20,30,40,2,3)).tolist() == [True, True, False]
+    assert sl.similar_matrix().tolist() == [[True, True, False], [True, True, False], [False, False, True]]
+    assert sl.similar_matrix(check_frame_overlay = False)[0].tolist() == [True, True, True]
+    # MBR
+    assert sl.mbr().to_rects(DicomRect) == [DicomRect(10, 22, 30, 44, 2, 3)]
+    assert sl.mbr([1, 0, 1]).to_rects(Rect) == [Rect(11, 21, 31, 41), Rect(10, 22, 30, 44)]
+    tl = RectList.from_rects([DicomRectText(1, 2, 3, 4, 0, -1, 1, 'jane'), DicomRectText(0, 2, 3, 5, 0, -1, 1, 'jane mac')])
+    assert tl.mbr().to_rects()[0].text_tuple()[1] == 'jane mac'
+    # Masks, both ways of building them give the same result
+    expected = np.zeros((30, 50), dtype = bool)
+    expected[1:12, 2:13] = expected[3:34, 4:45] = expected[4:31, 5:41] = expected[10:31, 10:41] = True
+    assert (rl.mask(30, 50) == expected).all()
+    assert (np.unpackbits(rl.mask(30, 50, packed = True), axis = -1, count = 50) == expected).all()
+    many = RectList.concatenate([rl] * 4)
+    assert len(many) > RectList.mask_summed_area_threshold
+    assert (many.mask(30, 50) == expected).all()
+    # Grouping by frame, overlay
+    groups = rl.frame_overlay_groups()
+    assert sorted(groups.keys()) == [(-1, -1), (9, 10)]
+    assert len(groups[(-1, -1)]) == 5
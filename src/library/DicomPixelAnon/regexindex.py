@@ -0,0 +1,276 @@
+""" The RegexIndex class speeds up testing a string against a long
+list of regular expressions, such as the OCR allowlist, by only
+running the regexes which could possibly match.
+  At load time the literal substrings which every match of a regex
+must contain are extracted from the parsed regex. An Aho-Corasick
+automaton over all of those literals finds which ones are present
+in the text, and only the regexes whose literals are all present
+are actually run. Regexes without any required literals are always run.
+  The results are identical to running every regex in turn.
+"""
+# Literals are compared in lower case so that (?i) and [kK] style
+# patterns can be indexed. To keep exactly the same semantics as re
+# only ASCII characters are indexed, and non-ASCII text bypasses the
+# index (re.IGNORECASE has some unusual non-ASCII case equivalences).
+
+import re
+from collections import deque
+try:
+    import re._parser as sre_parse # python 3.11 onwards
+except ImportError:
+    import sre_parse
+try:
+    import ahocorasick # pyahocorasick is optional
+except ImportError:
+    ahocorasick = False
+
+_LITERAL = sre_parse.LITERAL
+_IN = sre_parse.IN
+_BRANCH = sre_parse.BRANCH
+_SUBPATTERN = sre_parse.SUBPATTERN
+_REPEATS = [sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT]
+if hasattr(sre_parse, 'POSSESSIVE_REPEAT'):
+    _REPEATS.append(sre_parse.POSSESSIVE_REPEAT)
+_ATOMIC_GROUP = getattr(sre_parse, 'ATOMIC_GROUP', None)
+
+
+# ---------------------------------------------------------------------
+
+class AhoCorasick:
+    """ Find which of a set of words occur anywhere in a text,
+    in a single pass over the text. Uses pyahocorasick if installed,
+    otherwise a pure Python automaton.
+    """
+    def __init__(self, words):
+        words = set(words)
+        if ahocorasick:
+            self._automaton = ahocorasick.Automaton()
+            for word in words:
+                self._automaton.add_word(word, word)
+            if words:
+                self._automaton.make_automaton()
+            else:
+                self._automaton = None
+            return
+        self._automaton = None
+        # Build a trie: goto[state] maps char to next state
+        self._goto = [{}]
+        self._out = [set()]
+        for word in words:
+            state = 0
+            for ch in word:
+                if ch not in self._goto[state]:
+                    self._goto.append({})
+                    self._out.append(set())
+                    self._goto[state][ch] = len(self._goto) - 1
+                state = self._goto[state][ch]
+            self._out[state].add(word)
+        # Breadth-first to add the failure links
+        self._fail = [0] * len(self._goto)
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, nxt in self._goto[state].items():
+                queue.append(nxt)
+                fail = self._fail[state]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[nxt] = self._goto[fail].get(ch, 0)
+                self._out[nxt] |= self._out[self._fail[nxt]]
+
+    def findall(self, text):
+        """ Return the set of words which occur in the text.
+        """
+        if ahocorasick:
+            if not self._automaton:
+                return set()
+            return set(word for _, word in self._automaton.iter(text))
+        found = set()
+        goto, fail, out = self._goto, self._fail, self._out
+        state = 0
+        for ch in text:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if out[state]:
+                found |= out[state]
+        return found
+
+
+def test_AhoCorasick():
+    ac = AhoCorasick(['he', 'she', 'his', 'hers', 'kv'])
+    assert ac.findall('ushers') == {'she', 'he', 'hers'}
+    assert ac.findall('kv 80 mas') == {'kv'}
+    assert ac.findall('nothing') == set()
+    assert AhoCorasick([]).findall('text') == set()
+
+
+# ---------------------------------------------------------------------
+
+def _literal_char(op, av):
+    """ Return the lower-case ASCII character matched by a parsed regex
+    item if it only ever matches that one character (ignoring case),
+    e.g. 'k' or [kK], otherwise None.
+    """
+    if op is _LITERAL:
+        return chr(av).lower() if av < 128 else None
+    if op is _IN and av:
+        if all(o is _LITERAL and c < 128 for o, c in av):
+            chars = set(chr(c).lower() for _, c in av)
+            if len(chars) == 1:
+                return chars.pop()
+    return None
+
+
+def _flatten(items):
+    """ Yield the items of a parsed regex with the contents of any
+    (non-optional) groups inlined so that literal runs continue across them.
+    """
+    for op, av in items:
+        if op is _SUBPATTERN:
+            yield from _flatten(av[-1])
+        elif _ATOMIC_GROUP and op is _ATOMIC_GROUP:
+            yield from _flatten(av)
+        else:
+            yield op, av
+
+
+def _best_clause(clauses):
+    """ Choose the most selective clause, the one whose shortest literal
+    is the longest, preferring clauses with fewer alternatives.
+    """
+    return max(clauses, key = lambda c: (min(len(l) for l in c), -len(c)))
+
+
+def required_literals(items):
+    """ Return a list of clauses, each a frozenset of lower-case literal
+    strings, such that any string matched by the parsed regex items
+    contains at least one literal from every clause.
+    An empty list means nothing is known to be required.
+    """
+    clauses = []
+    run = []
+    def flush():
+        if run:
+            clauses.append(frozenset([''.join(run)]))
+            run.clear()
+    for op, av in _flatten(items):
+        ch = _literal_char(op, av)
+        if ch is not None:
+            run.append(ch)
+            continue
+        flush()
+        if op in _REPEATS:
+            lo, _, body = av
+            if lo >= 1:
+                clauses.extend(required_literals(body))
+        elif op is _BRANCH:
+            # Each alternative must contribute a clause,
+            # otherwise the branch as a whole requires nothing.
+            alt_clauses = [required_literals(alt) for alt in av[1]]
+            if all(alt_clauses):
+                clauses.append(frozenset().union(*[_best_clause(c) for c in alt_clauses]))
+    flush()
+    return clauses
+
+
+def test_required_literals():
+    def req(pattern):
+        return [set(c) for c in required_literals(sre_parse.parse(pattern))]
+    assert req('abc') == [{'abc'}]
+    assert req('(?i)AbC') == [{'abc'}]
+    assert req('[kK][vV][pP]? 80 mAs') == [{'kv'}, {' 80 mas'}]
+    assert req('a(bc)d') == [{'abcd'}]
+    assert req('x(erect|supine)') == [{'x'}, {'erect', 'supine'}]
+    assert req('(erect|.*)') == []
+    assert req('(ab)+c') == [{'ab'}, {'c'}]
+    assert req('(ab)?c') == [{'c'}]
+    assert req('[0-9]+') == []
+    assert req('café') == [{'caf'}]
+
+
+# ---------------------------------------------------------------------
+
+class RegexIndex:
+    """ Holds a list of compiled regexes and tests whether a string
+    fully matches any of them, running only those regexes whose
+    required literals are all present in the string.
+    """
+    def __init__(self, regex_list):
+        """ regex_list can contain strings or compiled re.Pattern objects.
+        """
+        self.regex_list = [re.compile(r) if isinstance(r, str) else r for r in regex_list]
+        self._clauses = []          # per regex, list of clauses
+        self._always = []           # indexes of regexes with no literals
+        self._by_literal = {}       # literal -> list of regex indexes
+        for idx, regex in enumerate(self.regex_list):
+            clauses = required_literals(sre_parse.parse(regex.pattern, regex.flags))
+            self._clauses.append(clauses)
+            if not clauses:
+                self._always.append(idx)
+                continue
+            # Only the best clause is indexed, the rest are checked later
+            for literal in _best_clause(clauses):
+                self._by_literal.setdefault(literal, []).append(idx)
+        self._automaton = AhoCorasick(self._by_literal.keys() |
+            set(l for clauses in self._clauses for c in clauses for l in c))
+
+    def __repr__(self):
+        return '<RegexIndex %d regexes, %d always run>' % (len(self.regex_list), len(self._always))
+
+    def __len__(self):
+        return len(self.regex_list)
+
+    def candidates(self, text):
+        """ Return a sorted list of indexes of the regexes which
+        could possibly match the given text.
+        """
+        if not text.isascii():
+            return list(range(len(self.regex_list)))
+        found = self._automaton.findall(text.lower())
+        idx_set = set(self._always)
+        for literal in found:
+            for idx in self._by_literal.get(literal, []):
+                if all(not clause.isdisjoint(found) for clause in self._clauses[idx]):
+                    idx_set.add(idx)
+        return sorted(idx_set)
+
+    def fullmatch(self, text):
+        """ Return the first regex (in the original order) which matches
+        the whole of text, or None if no regex matches.
+        """
+        for idx in self.candidates(text):
+            if self.regex_list[idx].fullmatch(text):
+                return self.regex_list[idx]
+        return None
+
+
+def test_RegexIndex():
+    regexes = ['[kK][vV][pP]?( |:)?[0-9]{2,3} mAs',
+        '(?i)(pa|ap)? ?erect', '(?i)RLQ', '[0-9]+', '']
+    index = RegexIndex(regexes)
+    assert len(index) == 5
+    assert index.fullmatch('kV 80 mAs').pattern == regexes[0]
+    assert index.fullmatch('AP ERECT').pattern == regexes[1]
+    assert index.fullmatch('rlq').pattern == regexes[2]
+    assert index.fullmatch('123').pattern == regexes[3]
+    assert index.fullmatch('').pattern == regexes[4]
+    assert index.fullmatch('NOT ERECT') is None
+    assert index.candidates('hello') == [3, 4]
+
+
+def test_RegexIndex_allowlist():
+    """ Check the index gives identical results to a linear scan
+    over the real allowlist and the allowlist test strings.
+    """
+    import os
+    srcdir = os.path.join(os.path.dirname(__file__), '..', '..')
+    with open(os.path.join(srcdir, '..', 'data', 'ocr_allowlist_regex.txt')) as fd:
+        regex_list = [re.compile(line.strip()) for line in fd.readlines()]
+    index = RegexIndex(regex_list)
+    testdir = os.path.join(srcdir, 'testing', 'test_files_ocr_allowlisting')
+    for testfile in ['should_match.txt', 'should_not_match.txt']:
+        with open(os.path.join(testdir, testfile)) as fd:
+            for text in fd.read().split('\n'):
+                expected = any(r.fullmatch(text) for r in regex_list)
+                assert (index.fullmatch(text) is not None) == expected, text
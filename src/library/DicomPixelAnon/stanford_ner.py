@@ -36,11 +36,16 @@ Version:    2016-07-08
 # ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
 # OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
 
+import atexit
+import logging
 import os
 import pickle
+import queue
+import sys
+import threading
 from argparse import ArgumentParser
 from platform import system
-from subprocess import Popen
+from subprocess import Popen, DEVNULL, PIPE
 from sys import argv
 from sys import stderr
 import tempfile
@@ -71,7 +76,107 @@ def process_entity_relations(entity_relations_str, verbose=True):
     return entity_relations
 
 
+def find_java():
+    """ Return the path to Java 8, in case the default is Java 11,
+    otherwise the default java.
+    """
+    java_bin_path = JAVA_BIN_PATH
+    #   the isdir test also works with symbolic links.
+    for path in [
+        '/usr/lib/jvm/java-8-openjdk-amd64',
+        '/usr/lib/jvm/jre-1.8.0',
+        '/usr/lib/jvm/java-1.8.0']:
+        if os.path.isdir(path):
+            java_bin_path = os.path.join(path, 'bin/java')
+    return java_bin_path
+
+
+def parse_tabbed_entities(results_str):
+    """ Convert the lines output in tabbedEntities format into a list
+    of [entity_name, entity_type] ignoring text which is not an entity.
+    """
+    results = []
+    for res in results_str:
+        if len(res.strip()) > 0:
+            split_res = res.split('\t')
+            if len(split_res) < 2:
+                continue
+            entity_name = split_res[0]
+            entity_type = split_res[1]
+
+            if len(entity_name) > 0 and len(entity_type) > 0:
+                results.append([entity_name.strip(), entity_type.strip()])
+    return results
+
+
+def test_parse_tabbed_entities():
+    lines = ['Barack Obama\tPERSON\twas born in\n', 'Hawaii\tLOCATION\t.\n', '\t\tnothing here\n', '\n']
+    assert parse_tabbed_entities(lines) == [['Barack Obama', 'PERSON'], ['Hawaii', 'LOCATION']]
+
+
+def test_StanfordNERServer(tmpdir):
+    """ Check the framing of texts and output using a Python program which
+    behaves like CRFClassifier -readStdin (a document ends after three
+    blank lines, and its output need not end with a newline), calling
+    every capitalised word a PERSON.
+    """
+    fake = os.path.join(tmpdir, 'fake_crf.py')
+    with open(fake, 'w') as fd:
+        fd.write("""import sys
+blank, doc = 0, []
+while True:
+    line = sys.stdin.readline()
+    if not line:
+        break
+    if line.strip():
+        blank = 0
+        doc.append(line.strip())
+        continue
+    blank += 1
+    if blank == 3:
+        words = ' '.join(doc).split()
+        sys.stdout.write('\\n'.join('%s\\tPERSON\\t' % w if w[0].isupper() else '\\t\\t%s' % w for w in words))
+        sys.stdout.flush()
+        doc = []
+""")
+    server = StanfordNERServer(str(tmpdir))
+    server.command = lambda: [sys.executable, fake]
+    texts = ['Barack Obama was born', '', 'nothing here', 'line one\nJane\n\n\n\nDoe']
+    assert server.classify_batch(texts) == [ [['Barack', 'PERSON'], ['Obama', 'PERSON']], [], [],
+        [['Jane', 'PERSON'], ['Doe', 'PERSON']] ]
+    assert server.classify('Hawaii') == [['Hawaii', 'PERSON']]
+    # Restarted if the process has died
+    server.process.kill()
+    server.process.wait()
+    assert server.classify('Hawaii') == [['Hawaii', 'PERSON']]
+    server.stop()
+    assert not server.is_running()
+
+
+def test_StanfordNERServer_java():
+    """ Check the framing against the real CRFClassifier, if Java and the
+    stanford-ner distribution are installed in $CORENLP_DATA_ROOT.
+    """
+    import pytest
+    import shutil
+    stanford_dir = os.environ.get('CORENLP_DATA_ROOT', STANFORD_DIR)
+    if not (shutil.which(find_java()) and os.path.isfile(os.path.join(stanford_dir,
+            'classifiers', 'english.all.3class.distsim.crf.ser.gz'))):
+        pytest.skip('needs java and the Stanford NER classifier in $CORENLP_DATA_ROOT')
+    server = StanfordNERServer(stanford_dir)
+    results = server.classify_batch(['Barack Obama was born in Hawaii.', '', 'nothing here',
+        'Jane Doe\n\n\n\nlives in Paris'])
+    server.stop()
+    assert results[0] == [['Barack Obama', 'PERSON'], ['Hawaii', 'LOCATION']]
+    assert results[1:3] == [[], []]
+    assert ['Paris', 'LOCATION'] in results[3]
+
+
 def stanford_ner(text, verbose=True, stanford_dir=None):
+    """ Run a new Java process to classify the text.
+    It is much faster to use stanford_ner_server(stanford_dir).classify(text)
+    which keeps a Java process running.
+    """
     infile = tempfile.NamedTemporaryFile()
     filename = infile.name
     infile.write(text.encode())
@@ -80,15 +185,9 @@ def stanford_ner(text, verbose=True, stanford_dir=None):
     out = outfile.name
 
     # Find Java 8, in case the default is Java 11.
-    #   the isdir test also works with symbolic links.
-    for path in [
-        '/usr/lib/jvm/java-8-openjdk-amd64',
-        '/usr/lib/jvm/jre-1.8.0',
-        '/usr/lib/jvm/java-1.8.0']:
-        if os.path.isdir(path):
-            JAVA_BIN_PATH = os.path.join(path, 'bin/java')
+    java_bin_path = find_java()
 
-    command = f'{JAVA_BIN_PATH} -mx1g -cp "{stanford_dir}/*:{stanford_dir}/lib/*" ' \
+    command = f'{java_bin_path} -mx1g -cp "{stanford_dir}/*:{stanford_dir}/lib/*" ' \
                f'edu.stanford.nlp.ie.NERClassifierCombiner ' \
                f'-ner.model {stanford_dir}/classifiers/english.all.3class.distsim.crf.ser.gz ' \
                f'-outputFormat tabbedEntities -textFile {filename} > {out}'
@@ -104,16 +203,160 @@ def stanford_ner(text, verbose=True, stanford_dir=None):
     with open(out, 'r') as output_file:
         results_str = output_file.readlines()
 
-    results = []
-    for res in results_str:
-        if len(res.strip()) > 0:
-            split_res = res.split('\t')
-            entity_name = split_res[0]
-            entity_type = split_res[1]
+    return parse_tabbed_entities(results_str)
 
-            if len(entity_name) > 0 and len(entity_type) > 0:
-                results.append([entity_name.strip(), entity_type.strip()])
-    return results
+
+class StanfordNERServer:
+    """ Keeps one Java process running the Stanford CRFClassifier so that
+    the classifier is only loaded once. Texts are written to its standard
+    input and the entities read from its standard output, so nothing
+    listens on the network (the Stanford NERServer cannot be bound to
+    localhost). A batch of texts is streamed through the pipe at once.
+    The process is started when first needed and restarted if it fails.
+    """
+    startup_timeout = 120 # seconds to wait for the classifier to load
+    timeout = 60          # seconds to wait for each text to be classified
+    # With -readStdin the classifier treats three blank lines as the end of
+    # a document, so each text is sent as a document followed by a document
+    # containing only this marker, which shows where its output ends
+    # (test_StanfordNERServer_java checks this if the classifier is installed).
+    separator = 'StanfordNerEndOfText'
+
+    def __init__(self, stanford_dir, verbose=False):
+        self.stanford_dir = os.path.abspath(stanford_dir)
+        self.verbose = verbose
+        self.process = None
+        self._chunks = None
+        self._loaded = False
+
+    def __del__(self):
+        self.stop()
+
+    def __repr__(self):
+        return '<StanfordNERServer %s %s>' % (self.stanford_dir,
+            'running' if self.is_running() else 'stopped')
+
+    def is_running(self):
+        return self.process is not None and self.process.poll() is None
+
+    def command(self):
+        """ Return the command line of the Java process.
+        """
+        return [find_java(), '-mx1g',
+            '-cp', f'{self.stanford_dir}/*:{self.stanford_dir}/lib/*',
+            'edu.stanford.nlp.ie.crf.CRFClassifier',
+            '-loadClassifier', f'{self.stanford_dir}/classifiers/english.all.3class.distsim.crf.ser.gz',
+            '-outputFormat', 'tabbedEntities',
+            '-readStdin']
+
+    def start(self):
+        """ Start the Java process, and a thread reading its output.
+        Raises RuntimeError if it cannot be started.
+        """
+        self.stop()
+        command = self.command()
+        logging.debug('Starting %s' % ' '.join(command))
+        try:
+            self.process = Popen(command, stdin=PIPE, stdout=PIPE,
+                stderr=None if self.verbose else DEVNULL)
+        except OSError as e:
+            raise RuntimeError('cannot run stanford_ner (%s)' % e)
+        self._loaded = False
+        self._chunks = queue.Queue()
+        threading.Thread(target=self._read_output, args=(self.process.stdout, self._chunks), daemon=True).start()
+
+    def _read_output(self, stdout, chunks):
+        """ Thread which puts the output into the queue as it arrives,
+        not waiting for whole lines, then None when the process exits.
+        """
+        while True:
+            chunk = os.read(stdout.fileno(), 65536)
+            if not chunk:
+                break
+            chunks.put(chunk)
+        chunks.put(None)
+
+    def stop(self):
+        """ Terminate the Java process, if running.
+        """
+        process = getattr(self, 'process', None)
+        if process is not None and process.poll() is None:
+            try:
+                process.stdin.close()
+            except OSError:
+                pass
+            process.terminate()
+            try:
+                process.wait(timeout=10)
+            except Exception:
+                process.kill()
+        self.process = None
+
+    def _classify_batch(self, texts):
+        # Each text must be one line as blank lines end a document
+        lines = [ ' '.join(text.replace(StanfordNERServer.separator, ' ').split()) for text in texts ]
+        request = ''.join( (line + '\n\n\n\n' if line else '') + StanfordNERServer.separator + '\n\n\n\n'
+            for line in lines )
+        self.process.stdin.write(request.encode())
+        self.process.stdin.flush()
+        separator = StanfordNERServer.separator.encode()
+        results = []
+        output = b''
+        for _ in lines:
+            # The output of a text ends where the separator appears,
+            # which need not be at the end of a line.
+            while separator not in output:
+                timeout = StanfordNERServer.timeout if self._loaded else StanfordNERServer.startup_timeout
+                try:
+                    chunk = self._chunks.get(timeout = timeout)
+                except queue.Empty:
+                    raise RuntimeError('stanford_ner did not reply within %d seconds' % timeout)
+                if chunk is None:
+                    raise RuntimeError('stanford_ner exited with code %s' % self.process.poll())
+                self._loaded = True
+                output += chunk
+            text_output, output = output.split(separator, 1)
+            results.append(parse_tabbed_entities(text_output.decode(errors='replace').splitlines()))
+        return results
+
+    def classify(self, text):
+        """ Return a list of [entity_name, entity_type] like stanford_ner().
+        """
+        return self.classify_batch([text])[0]
+
+    def classify_batch(self, texts):
+        """ Return a list of results from classify(), one per text,
+        sending all the texts to the process before reading the results.
+        Raises RuntimeError if the process fails twice.
+        """
+        if not self.is_running():
+            self.start()
+        try:
+            return self._classify_batch(texts)
+        except (OSError, RuntimeError) as e:
+            logging.warning('stanford_ner failed (%s), restarting' % e)
+            self.start()
+            return self._classify_batch(texts)
+
+
+# One server per stanford_dir in each process, see stanford_ner_server()
+_servers = {}
+
+def stanford_ner_server(stanford_dir, verbose=False):
+    """ Return the StanfordNERServer for this process and stanford_dir,
+    creating it if necessary (the Java process is not started until needed).
+    """
+    key = (os.getpid(), os.path.abspath(stanford_dir))
+    if key not in _servers:
+        _servers[key] = StanfordNERServer(stanford_dir, verbose=verbose)
+    return _servers[key]
+
+
+@atexit.register
+def _stop_servers():
+    for key, server in _servers.items():
+        if key[0] == os.getpid():
+            server.stop()
 
 
 def main(args):
@@ -134,3 +377,4 @@ def main(args):
 
 if __name__ == '__main__':
     exit(main(argv))
+
@@ -0,0 +1,204 @@
+""" The TextSimilarity class decides whether two OCR text strings are
+similar enough to be considered the same text, as used when coalescing
+similar rectangles. The same strings are compared over and over again
+so the results are cached, and pairs which cannot possibly be similar
+are rejected by cheap length and q-gram tests before computing the
+Damerau-Levenshtein edit distance.
+"""
+# Similarity is 1 - distance / length of the longer string, as returned
+# by fastDamerauLevenshtein with similarity=True. If that library is not
+# installed then strings are only similar if they are identical.
+#
+# The filters are lower bounds on the distance so they never reject a pair
+# which would have passed:
+#  - the distance is at least the difference in lengths
+#  - every edit (including a transposition) destroys at most q+1 of the
+#    q-grams of the longer string, so a string with n q-grams which shares
+#    fewer than n - d*(q+1) of them with the other is more than d edits away.
+
+import sys
+from collections import Counter
+import numpy as np
+try:
+    from fastDamerauLevenshtein import damerauLevenshtein
+except:
+    damerauLevenshtein = False
+
+
+def osa_similarity(a, b):
+    """ Pure Python optimal string alignment (restricted Damerau-Levenshtein)
+    similarity, 1.0 for identical strings down to 0.0.
+    """
+    if a == b:
+        return 1.0
+    prev2, prev = None, list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        cur = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i-1] == b[j-1] else 1
+            cur[j] = min(prev[j] + 1, cur[j-1] + 1, prev[j-1] + cost)
+            if i > 1 and j > 1 and a[i-1] == b[j-2] and a[i-2] == b[j-1]:
+                cur[j] = min(cur[j], prev2[j-2] + 1)
+        prev2, prev = prev, cur
+    return 1.0 - prev[-1] / max(len(a), len(b))
+
+
+def exact_similarity(a, b):
+    """ Similarity used when no edit distance library is installed """
+    return 1.0 if a == b else 0.0
+
+
+class TextSimilarity:
+    """ Tests whether strings are similar, caching the results.
+    """
+    # Strings must be at least this similar to be the same text
+    limit = 0.9
+    # Length of the substrings used by the q-gram filter
+    q = 2
+    # Maximum number of pairs remembered
+    cache_size = 1 << 20
+
+    def __init__(self, limit = None, similarity_func = None):
+        """ similarity_func(a,b) returns 0.0 to 1.0, defaults to
+        fastDamerauLevenshtein if installed, otherwise exact match.
+        """
+        self.limit = TextSimilarity.limit if limit is None else limit
+        if similarity_func:
+            self.similarity_func = similarity_func
+        elif damerauLevenshtein:
+            self.similarity_func = lambda a, b: damerauLevenshtein(a, b, similarity = True)
+        else:
+            self.similarity_func = exact_similarity
+        self._cache = {}
+        self._qgrams = {}
+        self.hits = 0
+        self.filtered = 0
+        self.computed = 0
+
+    def __repr__(self):
+        return '<TextSimilarity limit=%s %d cached, %d hits, %d filtered, %d computed>' % (
+            self.limit, len(self._cache), self.hits, self.filtered, self.computed)
+
+    def _qgram_counts(self, text):
+        counts = self._qgrams.get(text)
+        if counts is None:
+            q = TextSimilarity.q
+            counts = Counter(text[i:i+q] for i in range(len(text) - q + 1))
+            if len(self._qgrams) < TextSimilarity.cache_size:
+                self._qgrams[text] = counts
+        return counts
+
+    def _cannot_be_similar(self, a, b):
+        """ Return True if the pair is certainly below the limit.
+        """
+        if self.similarity_func is exact_similarity:
+            return a != b
+        longest = max(len(a), len(b))
+        if not longest:
+            return False
+        max_dist = int((1.0 - self.limit) * longest + 1e-9)
+        if abs(len(a) - len(b)) > max_dist:
+            return True
+        q = TextSimilarity.q
+        long_text = a if len(a) >= len(b) else b
+        need = (len(long_text) - q + 1) - max_dist * (q + 1)
+        if need > 0:
+            common = sum((self._qgram_counts(a) & self._qgram_counts(b)).values())
+            if common < need:
+                return True
+        return False
+
+    def similar(self, a, b):
+        """ Return True if the strings are at least limit similar.
+        """
+        if a == b:
+            return True
+        key = (a, b) if a < b else (b, a)
+        rc = self._cache.get(key)
+        if rc is not None:
+            self.hits += 1
+            return rc
+        if self._cannot_be_similar(a, b):
+            self.filtered += 1
+            rc = False
+        else:
+            self.computed += 1
+            rc = self.similarity_func(a, b) >= self.limit
+        if len(self._cache) >= TextSimilarity.cache_size:
+            self._cache.clear()
+        self._cache[(sys.intern(key[0]), sys.intern(key[1]))] = rc
+        return rc
+
+    def similar_many(self, text, others):
+        """ Return a list of booleans, whether text is similar to each
+        of the others. The length filter is applied to all of them at once.
+        """
+        if not others:
+            return []
+        rc = np.array([other == text for other in others])
+        if self.similarity_func is exact_similarity:
+            return rc.tolist()
+        lengths = np.array([len(other) for other in others])
+        longest = np.maximum(lengths, len(text))
+        max_dist = np.floor((1.0 - self.limit) * longest + 1e-9)
+        possible = ~rc & (np.abs(lengths - len(text)) <= max_dist)
+        self.filtered += int(np.count_nonzero(~rc & ~possible))
+        for idx in np.flatnonzero(possible).tolist():
+            rc[idx] = self.similar(text, others[idx])
+        return rc.tolist()
+
+
+text_similarity = TextSimilarity()
+
+def similar_text(a, b):
+    """ Return True if the strings are similar, using a shared TextSimilarity """
+    return text_similarity.similar(a, b)
+
+
+# ---------------------------------------------------------------------
+
+def test_osa_similarity():
+    assert osa_similarity('jane maclean', 'jane maclan') >= 0.9
+    assert osa_similarity('jane maclean', 'jane macla') < 0.9
+    assert osa_similarity('abcd', 'abdc') == 0.75
+    assert osa_similarity('', '') == 1.0
+    assert osa_similarity('', 'ab') == 0.0
+
+
+def test_TextSimilarity():
+    ts = TextSimilarity(similarity_func = osa_similarity)
+    assert ts.similar('jane maclean', 'jane maclan')
+    assert not ts.similar('jane maclean', 'jane macla')
+    assert ts.similar('jane maclan', 'jane macla')
+    assert ts.similar('jane maclan', 'jane maclean') # cached
+    assert ts.hits == 1
+    assert not ts.similar('jane maclean', 'AP ERECT')
+    assert (ts.filtered, ts.computed) == (2, 2) # only the two close pairs were computed
+    # The filters never change the answer
+    import random
+    rng = random.Random(3)
+    words = ['jane maclean', 'jane mcclean', 'kV 80 mAs', 'kV 90 mAs', 'AP ERECT', 'PA ERECT', '01/02/2023', 'abc']
+    texts = set(words)
+    for word in words:
+        for _ in range(30):
+            chars = list(word)
+            for _ in range(rng.randint(0, 3)):
+                i = rng.randrange(len(chars))
+                op = rng.randint(0, 3)
+                if op == 0:
+                    chars[i] = rng.choice('abcxyz 0')
+                elif op == 1:
+                    del chars[i]
+                elif op == 2:
+                    chars.insert(i, rng.choice('abcxyz 0'))
+                elif i:
+                    chars[i-1], chars[i] = chars[i], chars[i-1]
+            texts.add(''.join(chars))
+    texts = sorted(texts)
+    ts = TextSimilarity(similarity_func = osa_similarity)
+    for a in texts:
+        assert ts.similar_many(a, texts) == [osa_similarity(a, b) >= 0.9 for b in texts]
+    assert ts.filtered > ts.computed
+    # Without an edit distance only identical strings are similar
+    ts = TextSimilarity(similarity_func = exact_similarity)
+    assert ts.similar_many('abc', ['abc', 'abd']) == [True, False]
@@ -8,27 +8,53 @@ multiple processes to run concurrently.
 # Fraction is currently set to 0.4 which allows two processes.
 # This should be imported before any pytorch functions are called.
 # If pytorch is not installed, too old, or CPU-only  then nothing happens.
+# A process which is one of many, e.g. in a multiprocessing pool,
+# can call share_between(processes) to take only its share of the
+# GPU memory and of the CPU cores.
 
-try:
-    import torch
-    torch.cuda.set_per_process_memory_fraction(0.4, 0)
-except ModuleNotFoundError:
-    # Ignore if torch not installed
-    pass
-except AttributeError:
-    # Ignore if torch too old so function missing
-    pass
-except AssertionError as e:
-    # Ignore if a CPU version of CUDA
-    if str(e) == "Torch not compiled with CUDA enabled":
+import os
+
+
+def set_memory_fraction(fraction):
+    """ Limit this process to the given fraction of the GPU memory.
+    """
+    try:
+        import torch
+        torch.cuda.set_per_process_memory_fraction(fraction, 0)
+    except ModuleNotFoundError:
+        # Ignore if torch not installed
         pass
-    else:
-        raise
-except RuntimeError as e:
-    # Ignore if no NVIDIA driver installed
-    if 'no NVIDIA driver' in str(e):
+    except AttributeError:
+        # Ignore if torch too old so function missing
         pass
-    else:
+    except AssertionError as e:
+        # Ignore if a CPU version of CUDA
+        if str(e) == "Torch not compiled with CUDA enabled":
+            pass
+        else:
+            raise
+    except RuntimeError as e:
+        # Ignore if no NVIDIA driver installed
+        if 'no NVIDIA driver' in str(e):
+            pass
+        else:
+            raise
+    except Exception as e:
         raise
-except Exception as e:
-    raise
+
+
+def share_between(processes):
+    """ Limit this process to its share of the GPU memory (at most the
+    usual 0.4) and of the CPU threads when it is one of processes
+    running at the same time.
+    """
+    processes = max(1, processes)
+    set_memory_fraction(min(0.4, 0.8 / processes))
+    try:
+        import torch
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // processes))
+    except ModuleNotFoundError:
+        pass
+
+
+set_memory_fraction(0.4)
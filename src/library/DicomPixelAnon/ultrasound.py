@@ -99,21 +99,20 @@ def test_read_DicomRectText_list_from_region_tags():
     # Open the file to check
     rectlist = read_DicomRectText_list_from_region_tags(filename)
     #print(rectlist)
-    # XXX  NOTE some of these coordinates are off-by-one!!
-    # But we would need to fix rect.py before fixing this test.
     expected = [         # format is left,top,right,bottom
-        (0,0,1023,20),
-        (0,20,10,40),
-        (30,20,1023,40),
-        (0,40,1023,60),
-        (0,60,50,80),
-        (70,60,1023,80),
-        (0,80,1023,1023)
+        (0,0,1023,19),
+        (0,20,9,40),
+        (31,20,1023,40),
+        (0,41,1023,59),
+        (0,60,49,80),
+        (71,60,1023,80),
+        (0,81,1023,1023)
     ]
     os.remove(filename)
     for rect in rectlist:
         #if not rect.ltrb() in expected: print('Unexpected %s' % (rect.ltrb(),))
         assert(rect.ltrb() in expected)
+    assert(len(rectlist) == len(expected))
 
 
 if __name__ == '__main__':
@@ -2,28 +2,43 @@ import re
 import argparse
 from os import mkdir
 from tqdm import tqdm
+from DicomPixelAnon.regexindex import RegexIndex
 
-def is_in_allowlist(s, rules, verbose=False):
-    """Checks if string matches any of the allowlist rules.
+def build_index(rules):
+    """Compile the allowlist rules into an index so that only the rules
+    which could match a string are tried.
 
     Args:
-        s (str): string to check
         rules (list): list of regex rules
-        verbose (bool, optional): if true, print matches (defaults to False)
 
     Returns:
-        boolean: True if s matches one of the allowlist rules, False o/w
+        RegexIndex: index of the compiled rules
     """
     for r in rules:
         try:
-            if re.fullmatch(r, s) is not None:  # found match, s is allowlisted
-                if verbose:
-                    print(f"Full text match:\n{s}\n{r}\n\n")
-                return True
+            re.compile(r)
         except re.error:
             print(re.error)
             print(f"problematic rule: {r}")
             exit()
+    return RegexIndex(rules)
+
+def is_in_allowlist(s, index, verbose=False):
+    """Checks if string matches any of the allowlist rules.
+
+    Args:
+        s (str): string to check
+        index (RegexIndex): index of the regex rules, from build_index()
+        verbose (bool, optional): if true, print matches (defaults to False)
+
+    Returns:
+        boolean: True if s matches one of the allowlist rules, False o/w
+    """
+    r = index.fullmatch(s)
+    if r is not None:  # found match, s is allowlisted
+        if verbose:
+            print(f"Full text match:\n{s}\n{r.pattern}\n\n")
+        return True
     return False
 
 def read_list_from_file(path):
@@ -42,6 +57,7 @@ def write_list_to_file(path, l):
 def main(verbose, reduced):
     allowlist = read_list_from_file("../../data/ocr_allowlist_regex.txt")
     print(f"Loaded {len(allowlist)} rules.")
+    index = build_index(allowlist)
     pos = read_list_from_file("test_files_ocr_allowlisting/should_match.txt")
     neg = read_list_from_file("test_files_ocr_allowlisting/should_not_match.txt")
     if reduced:
@@ -51,10 +67,10 @@ def main(verbose, reduced):
     false_neg = []
     for s in tqdm(pos):
         if not (reduced and s in red):
-            if not is_in_allowlist(s, allowlist):
+            if not is_in_allowlist(s, index):
                 false_neg.append(s)
     for s in tqdm(neg):
-        if is_in_allowlist(s, allowlist, verbose):
+        if is_in_allowlist(s, index, verbose):
             false_pos.append(s)
     # write results
     try:
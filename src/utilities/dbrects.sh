@@ -28,9 +28,10 @@ if [ -d "$db" ]; then
 fi
 
 case $param in
-    "all")     sql="select * from DicomRects";;
-    "rects")   sql="select * from DicomRects where left != -1";;
-    "summary") sql="select * from DicomRects where left = -1";;
+    "all")     where="";;
+    "rects")   where="where left != -1";;
+    "summary") where="where left = -1";;
 esac
+sql="select Files.path as filename, DicomRects.* from DicomRects join Files on Files.id = DicomRects.file_id $where"
 
 sqlite3 -csv -header -separator , -cmd "$sql" "$db" < /dev/null
@@ -48,17 +48,18 @@ drdb = DicomRectDB()
 # having the value being a list of rectangles (l,t,r,b)
 prev_group_by = ()
 rectlist_dict = {}
-for row in drdb.db(drdb.db.DicomRects.filename == drdb.db.DicomTags.filename).select(
+for row in drdb.db((drdb.db.DicomRects.file_id == drdb.db.DicomTags.file_id) &
+        (drdb.db.Files.id == drdb.db.DicomTags.file_id)).select(
         # select() takes: orderby=, groupby=, limitby=(0,9)
-        drdb.db.DicomTags.ALL, drdb.db.DicomRects.ALL,
+        drdb.db.Files.path, drdb.db.DicomTags.ALL, drdb.db.DicomRects.ALL,
         orderby = drdb.db.DicomTags.Modality |
             drdb.db.DicomTags.ManufacturerModelName |
             drdb.db.DicomTags.Rows |
             drdb.db.DicomTags.Columns
     ):
     # Read real Manufacturer etc from the file
-    if os.path.isfile(row.DicomTags.filename):
-        Manufacturer, ManufacturerModelName, SecondaryCaptureDeviceManufacturer, SecondaryCaptureDeviceManufacturerModelName, SoftwareVersions = read_Manufacturer_tags(row.DicomTags.filename)
+    if os.path.isfile(row.Files.path):
+        Manufacturer, ManufacturerModelName, SecondaryCaptureDeviceManufacturer, SecondaryCaptureDeviceManufacturerModelName, SoftwareVersions = read_Manufacturer_tags(row.Files.path)
 
     # Create dictionary key
     bits_to_group_by = (row.DicomTags.Modality,
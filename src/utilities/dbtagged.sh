@@ -11,4 +11,4 @@ fi
 if [ -d "$db" ]; then
     db="$db"/dcmaudit.sqlite.db
 fi
-sqlite3 -cmd 'select filename from DicomTags' "$db" < /dev/null
+sqlite3 -cmd 'select Files.path from DicomTags join Files on Files.id = DicomTags.file_id' "$db" < /dev/null
@@ -11,4 +11,4 @@ fi
 if [ -d "$db" ]; then
     db="$db"/dcmaudit.sqlite.db
 fi
-sqlite3 -csv -header -separator , -cmd 'select * from DicomTags' "$db" < /dev/null
+sqlite3 -csv -header -separator , -cmd 'select Files.path as filename, DicomTags.* from DicomTags join Files on Files.id = DicomTags.file_id' "$db" < /dev/null
@@ -14,12 +14,13 @@ fi
 
 # To get the OCR text from files which you tagged:
 sql='SELECT DicomTags.ocrtext FROM DicomTags
-     INNER JOIN DicomRects ON DicomTags.filename = DicomRects.filename'
+     INNER JOIN DicomRects ON DicomTags.file_id = DicomRects.file_id'
 
 # To get the filename of tagged files where the rectangle is
 #  very large but the detected text is small:
-sql='SELECT DicomRects.filename FROM DicomTags 
-     INNER JOIN DicomRects ON DicomTags.filename = DicomRects.filename 
+sql='SELECT Files.path AS filename FROM DicomTags 
+     INNER JOIN DicomRects ON DicomTags.file_id = DicomRects.file_id 
+     INNER JOIN Files ON Files.id = DicomRects.file_id 
      WHERE DicomRects.ocrtext != "" 
        AND DicomRects.left != -1 
        AND (DicomRects.right-DicomRects.left)*(DicomRects.bottom-DicomRects.top) > 3000 * LENGTH(DicomRects.ocrtext)'
@@ -5,6 +5,7 @@
 
 import argparse
 import csv
+import re
 from DicomPixelAnon.rect import DicomRect
 from DicomPixelAnon.dicomrectdb import DicomRectDB
 
@@ -26,7 +27,7 @@ def row_filter(row, imagetype=None, manufacturer=None):
     i.e. not the ones with -1,-1,-1,-1, and
     the imagetype/manufacturer can be a regex """
     # Ignore invalid rectangles
-    if -1 in [row['left'], row['right'], row['top'], row['bottom']]:
+    if -1 in [int(row['left']), int(row['right']), int(row['top']), int(row['bottom'])]:
         return False
     if imagetype and not re.match(imagetype, row['imagetype']):
             return False
@@ -44,17 +45,16 @@ def read_csv(filename):
     #   'ocr_engine',
     #   'left', 'top', 'right', 'bottom',
     #   'ocr_text', 'ner_engine', 'is_sensitive'
+    # All the rows are added in bulk by one database connection
     fp = open(filename, newline='')
     reader = csv.DictReader(fp)
-    for row in reader:
-        if row_filter(row):
-            add_to_db(row['filename'],
-                frame = row['frame'],
-                overlay = row['overlay'],
-                top = row['top'],
-                bottom = row['bottom'],
-                left = row['left'],
-                right = row['right'])
+    db = DicomRectDB()
+    db.add_many( (row['filename'], DicomRect(top = int(row['top']),
+            bottom = int(row['bottom']),
+            left = int(row['left']),
+            right = int(row['right']),
+            frame = int(row['frame']), overlay = int(row['overlay'])))
+        for row in reader if row_filter(row) )
 
 
 if __name__ == '__main__':
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+# Create a large synthetic DicomRectDB database and time the
+# common queries, with and without the indexes added by the
+# schema migrations, to check the database scales.
+
+import argparse
+import logging
+import random
+import tempfile
+import time
+from DicomPixelAnon.rect import DicomRectText
+from DicomPixelAnon.dicomrectdb import DicomRectDB
+
+
+# Metadata for a few made-up scanners
+def scanner_metadata(num_scanners):
+    return [ { 'Modality': random.choice(['CT', 'MR', 'CR', 'US', 'XA']),
+        'ImageType': '"ORIGINAL/PRIMARY"',
+        'ManufacturerModelName': 'Scanner %d' % idx,
+        'BurnedInAnnotation': 'YES',
+        'Rows': 1024,
+        'Columns': 1024 } for idx in range(num_scanners) ]
+
+
+def create_database(db, num_rows, rects_per_file, scanners):
+    """ Add num_rows rectangles, rects_per_file per file, and one tag
+    per file with the metadata of a random scanner.
+    Returns the list of filenames.
+    """
+    num_files = max(1, num_rows // rects_per_file)
+    filenames = [ 'synthetic/%06d/file%d.dcm' % (idx // 1000, idx) for idx in range(num_files) ]
+    def rects():
+        for filename in filenames:
+            for idx in range(rects_per_file):
+                t, l = random.randint(0, 1000), random.randint(0, 900)
+                yield filename, DicomRectText(t, t+20, l, l+100, 0, -1, 1, 'text %d' % idx, 1, 0)
+    db.add_many(rects())
+    lastmod = time.strftime('%Y-%m-%d %H:%M:%S')
+    columns = ['file_id', 'mark', 'Modality', 'ImageType', 'ManufacturerModelName',
+        'BurnedInAnnotation', 'Rows', 'Columns', 'last_modified', 'last_modified_by']
+    sql = 'INSERT INTO "DicomTags" (%s) VALUES (%s)' % (
+        ', '.join('"%s"' % col for col in columns), ', '.join(['?'] * len(columns)))
+    file_ids = db._file_ids(filenames)
+    rows, signatures = [], []
+    for filename in filenames:
+        meta = random.choice(scanners)
+        rows.append((file_ids[filename], 'F', meta['Modality'], meta['ImageType'], meta['ManufacturerModelName'],
+            meta['BurnedInAnnotation'], meta['Rows'], meta['Columns'], lastmod, db.username))
+        signatures.append((DicomRectDB.metadata_signature(meta), file_ids[filename]))
+    db.db._adapter.cursor.executemany(sql, rows)
+    db.db._adapter.cursor.executemany('UPDATE "Files" SET "signature" = ? WHERE "id" = ?', signatures)
+    db.db.commit()
+    # The tags were added behind its back so recreate the templates
+    db.rebuild_templates()
+    return filenames
+
+
+def time_queries(db, filenames, scanners, repeats, similar_repeats):
+    """ Return a dict of query name to average seconds per query """
+    results = {}
+    def timeit(name, func, count):
+        start = time.perf_counter()
+        for _ in range(count):
+            func()
+        results[name] = (time.perf_counter() - start) / count
+    timeit('query_rects', lambda: db.query_rects(random.choice(filenames)), repeats)
+    timeit('exists', lambda: db.exists(random.choice(filenames)), repeats)
+    timeit('processed_filenames', lambda: db.processed_filenames(), 1)
+    timeit('file_tagged', lambda: db.file_tagged(random.choice(filenames)), repeats)
+    timeit('file_marked_done', lambda: db.file_marked_done(random.choice(filenames)), repeats)
+    timeit('query_similar_rects', lambda: db.query_similar_rects('none', random.choice(scanners)), similar_repeats)
+    timeit('filename_substring', lambda: db.query_rect_filenames('/' + random.choice(filenames).split('/')[-1]), repeats)
+    timeit('filename_prefix', lambda: db.query_rect_filenames(prefix = random.choice(filenames).rsplit('/', 1)[0] + '/'), repeats)
+    timeit('query_template', lambda: db.query_template(random.choice(scanners)), repeats)
+    return results
+
+
+def drop_indexes(db):
+    """ Remove the indexes which the migrations created """
+    for (name,) in db.db.executesql("SELECT name FROM sqlite_master WHERE type = 'index' AND sql IS NOT NULL"):
+        db.db.executesql('DROP INDEX "%s"' % name)
+    for (name,) in db.db.executesql("SELECT name FROM sqlite_master WHERE type = 'trigger' AND name LIKE 'Files_path_%'"):
+        db.db.executesql('DROP TRIGGER "%s"' % name)
+    db.db.executesql('DROP TABLE IF EXISTS "FilesPath"')
+    db.db.commit()
+    db._path_index = False
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the DicomRectDB queries')
+    parser.add_argument('-v', '--verbose', action="store_true", help='verbose')
+    parser.add_argument('--rows', type=int, default=1000000, help='number of rectangles (default 1000000)')
+    parser.add_argument('--rects-per-file', type=int, default=10, help='rectangles per file (default 10)')
+    parser.add_argument('--scanners', type=int, default=50, help='number of different scanners (default 50)')
+    parser.add_argument('--repeats', type=int, default=200, help='number of times to run each query (default 200)')
+    parser.add_argument('--similar-repeats', type=int, default=1, help='number of times to run query_similar_rects (default 1, it is slow without indexes)')
+    parser.add_argument('--db', dest='db', action="store", help='database directory (default a temporary directory)')
+    args = parser.parse_args()
+    if args.verbose:
+        logging.basicConfig(level = logging.INFO)
+    random.seed(1)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        DicomRectDB.set_db_path(args.db if args.db else tmpdir)
+        db = DicomRectDB()
+        scanners = scanner_metadata(args.scanners)
+        start = time.perf_counter()
+        filenames = create_database(db, args.rows, args.rects_per_file, scanners)
+        print('Created %d rects in %d files in %.1f seconds' % (args.rows, len(filenames), time.perf_counter() - start))
+
+        indexed = time_queries(db, filenames, scanners, args.repeats, args.similar_repeats)
+        drop_indexes(db)
+        unindexed = time_queries(db, filenames, scanners, args.repeats, args.similar_repeats)
+
+        print('%-20s %15s %15s' % ('query', 'no index (ms)', 'indexed (ms)'))
+        for name in indexed:
+            print('%-20s %15.3f %15.3f' % (name, 1000 * unindexed[name], 1000 * indexed[name]))
+        if args.db:
+            # Put the indexes back
+            db.db.DicomRectDBSchema.update_or_insert(db.db.DicomRectDBSchema.id > 0, version = 0)
+            db.migrate()
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+# Export a table from the DicomRectDB database as JSON Lines, CSV or
+# Parquet. The rows are read and written a chunk at a time so memory
+# use does not depend on the size of the database.
+
+import argparse
+import logging
+import os
+import sys
+from DicomPixelAnon.dicomrectdb import DicomRectDB
+
+
+tables = { 'rects': 'DicomRects', 'tags': 'DicomTags', 'files': 'Files', 'templates': 'RectTemplates' }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export the DicomRectDB database')
+    parser.add_argument('-v', '--verbose', action="store_true", help='verbose')
+    parser.add_argument('--db', dest='db', action="store", help='database directory, file or URI')
+    parser.add_argument('-t', '--table', dest='table', action="store", choices=tables.keys(), default='rects', help='table to export (default rects)')
+    parser.add_argument('-f', '--format', dest='format', action="store", choices=['jsonl', 'csv', 'parquet'], default='jsonl', help='output format (default jsonl)')
+    parser.add_argument('-o', '--output', dest='output', action="store", help='output file (default stdout, required for parquet)')
+    parser.add_argument('--chunk-size', dest='chunk_size', type=int, default=DicomRectDB.export_chunk_size, help='rows read at a time (default %d)' % DicomRectDB.export_chunk_size)
+    args = parser.parse_args()
+    if args.verbose:
+        logging.basicConfig(level = logging.INFO)
+
+    if args.db and os.path.isfile(args.db):
+        db = DicomRectDB(args.db)
+    else:
+        if args.db:
+            DicomRectDB.set_db_path(args.db)
+        db = DicomRectDB()
+    DicomRectDB.export_chunk_size = args.chunk_size
+
+    table_name = tables[args.table]
+    if args.format == 'parquet':
+        if not args.output:
+            parser.error('--output is required for parquet')
+        db.export_parquet(args.output, table_name)
+    else:
+        fd = open(args.output, 'w', newline='') if args.output else sys.stdout
+        if args.format == 'csv':
+            db.export_csv(fd, table_name)
+        else:
+            db.export_jsonl(fd, table_name)
+        if args.output:
+            fd.close()
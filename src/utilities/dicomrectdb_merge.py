@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+# Merge the shard databases written by separate workers, each having
+# its own dcmaudit.<shard>.sqlite.db (see DicomRectDB.set_db_shard and
+# the --db-shard option), into the main database dcmaudit.sqlite.db.
+# Where a file is in more than one the newest rects and tags are kept.
+
+import argparse
+import logging
+import os
+import time
+from DicomPixelAnon.dicomrectdb import DicomRectDB
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Merge DicomRectDB shard databases into the main database')
+    parser.add_argument('-v', '--verbose', action="store_true", help='verbose')
+    parser.add_argument('--db', dest='db', action="store", help='database directory (default current directory)')
+    parser.add_argument('--remove', action="store_true", help='delete each shard after it has been merged')
+    parser.add_argument('shards', nargs='*', help='shard database files (default all dcmaudit.*.sqlite.db in the database directory)')
+    args = parser.parse_args()
+    if args.verbose:
+        logging.basicConfig(level = logging.INFO)
+
+    if args.db:
+        DicomRectDB.set_db_path(args.db)
+    db = DicomRectDB()
+    shards = args.shards if args.shards else DicomRectDB.shard_filenames()
+    start = time.perf_counter()
+    for shard in shards:
+        count = db.merge([shard])
+        print('Merged %d files from %s' % (count, shard))
+        if args.remove:
+            for suffix in ['', '-wal', '-shm']:
+                if os.path.exists(shard + suffix):
+                    os.remove(shard + suffix)
+    print('Merged %d shards in %.1f seconds' % (len(shards), time.perf_counter() - start))
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# Time many processes writing rectangles and tags at the same time,
+# either all to one database or each to its own shard, to check that
+# sharded writes scale with the number of processes, then time merging
+# the shards into the main database.
+
+import argparse
+import logging
+import multiprocessing
+import os
+import tempfile
+import time
+from DicomPixelAnon.rect import DicomRectText
+from DicomPixelAnon.dicomrectdb import DicomRectDB
+
+
+metadata_dict = { 'Modality': 'CT', 'ImageType': '"ORIGINAL/PRIMARY"', 'ManufacturerModelName': 'Scanner',
+    'BurnedInAnnotation': 'YES', 'Rows': 1024, 'Columns': 1024 }
+
+
+def write_files(db_dir, shard, worker, num_files, rects_per_file):
+    """ Add num_files files, each with rects_per_file rects and a tag,
+    one transaction each like dicom_ocr, to the shard (None for the
+    main database). Runs in a separate process. """
+    DicomRectDB.set_db_path(db_dir)
+    DicomRectDB.set_db_shard(shard)
+    db = DicomRectDB()
+    for idx in range(num_files):
+        filename = 'worker%d/file%d.dcm' % (worker, idx)
+        db.add_rects(filename, [DicomRectText(i * 20, i * 20 + 15, 10, 200, 0, -1, 1, 'text %d' % i, 1, 0)
+            for i in range(rects_per_file)])
+        db.mark_inspected(filename, metadata_dict = metadata_dict)
+    return db.retries
+
+
+def run(db_dir, num_processes, sharded, num_files, rects_per_file):
+    """ Return the seconds taken and the number of retries """
+    if not sharded:
+        # Create the shared database first, pydal cannot create it from many processes at once
+        DicomRectDB.set_db_path(db_dir)
+        DicomRectDB.set_db_shard(None)
+        DicomRectDB()
+    start = time.perf_counter()
+    with multiprocessing.Pool(num_processes) as pool:
+        retries = pool.starmap(write_files, [(db_dir, ('%d' % worker) if sharded else None, worker, num_files, rects_per_file)
+            for worker in range(num_processes)])
+    return time.perf_counter() - start, sum(retries)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark DicomRectDB writes from many processes, shared or sharded')
+    parser.add_argument('-v', '--verbose', action="store_true", help='verbose')
+    parser.add_argument('--processes', type=int, default=32, help='maximum number of writer processes (default 32)')
+    parser.add_argument('--files', type=int, default=200, help='files written by each process (default 200)')
+    parser.add_argument('--rects-per-file', type=int, default=10, help='rectangles per file (default 10)')
+    args = parser.parse_args()
+    if args.verbose:
+        logging.basicConfig(level = logging.INFO)
+
+    counts = [1]
+    while counts[-1] * 2 <= args.processes:
+        counts.append(counts[-1] * 2)
+    if counts[-1] != args.processes:
+        counts.append(args.processes)
+    print('%d CPUs, each process writes %d files with %d rects' % (os.cpu_count(), args.files, args.rects_per_file))
+    print('%10s %22s %22s' % ('processes', 'shared (files/s)', 'sharded (files/s)'))
+    base = {}
+    for num_processes in counts:
+        rates = {}
+        for sharded in [False, True]:
+            with tempfile.TemporaryDirectory() as tmpdir:
+                elapsed, retries = run(tmpdir, num_processes, sharded, args.files, args.rects_per_file)
+                rates[sharded] = num_processes * args.files / elapsed
+                base.setdefault(sharded, rates[sharded])
+                if sharded and num_processes == counts[-1]:
+                    # Merge the largest run
+                    DicomRectDB.set_db_path(tmpdir)
+                    DicomRectDB.set_db_shard(None)
+                    start = time.perf_counter()
+                    merged = DicomRectDB().merge(DicomRectDB.shard_filenames())
+                    merge_time = time.perf_counter() - start
+        print('%10d %12.0f (x%5.1f) %12.0f (x%5.1f)' % (num_processes,
+            rates[False], rates[False] / base[False], rates[True], rates[True] / base[True]))
+    print('Merged %d shards, %d files, in %.1f seconds (%.0f files/s)' % (counts[-1], merged, merge_time, merged / merge_time))